@@ -0,0 +1,219 @@
+import asyncio
+import glob
+import json
+import os
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal, get_db
+from app.models import Temperature, create_tables
+from app.settings import BASE_DIR, ARCHIVE_DIR, RETENTION_DAYS, RETENTION_INTERVAL, log
+from app.writer import writer
+
+Columns = Tuple[np.ndarray, np.ndarray, np.ndarray]
+STATE_FILE = 'state.json'
+
+
+def empty() -> Columns:
+	return np.empty(0, dtype='datetime64[us]'), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+
+def day_range(day: date) -> Tuple[datetime, datetime]:
+	start = datetime.combine(day, time())
+	return start, start + timedelta(days=1)
+
+
+class ArchiveStore:
+	"""Raw readings moved out of the temperature table.
+
+	Each day is one compressed npz file, `<root>/YYYY/MM/YYYY-MM-DD.npz`, with
+	recorded_at, sensor_id and temperature columns sorted by recorded_at.
+	Every reading before `through` lives in the archive and every later one
+	in the table. `through` is only advanced after the table rows of a day are
+	deleted, so a day that is archived twice is never read twice. It is read
+	from the state file again whenever that file changes, so export workers
+	and the server see days archived by another process.
+	"""
+
+	def __init__(self, root: str = os.path.join(BASE_DIR, ARCHIVE_DIR)):
+		self.root = root
+		self.state = os.path.join(root, STATE_FILE)
+		self._through: Optional[datetime] = None
+		self._state_mtime: Optional[Tuple[int, int]] = None
+
+	@property
+	def through(self) -> Optional[datetime]:
+		try:
+			stat = os.stat(self.state)
+			# The state file is replaced, never rewritten, so a new inode also means new contents.
+			mtime = stat.st_ino, stat.st_mtime_ns
+		except FileNotFoundError:
+			mtime = None
+		if mtime != self._state_mtime:
+			self._through = None
+			if mtime is not None:
+				with open(self.state) as file:
+					self._through = datetime.fromisoformat(json.load(file)['through'])
+			self._state_mtime = mtime
+		return self._through
+
+	def path(self, day: date) -> str:
+		return os.path.join(self.root, f'{day:%Y}', f'{day:%m}', f'{day.isoformat()}.npz')
+
+	def days(self, after: Optional[datetime] = None, before: Optional[datetime] = None) -> List[date]:
+		"""Archived days that may hold readings in (after, before)."""
+		through = self.through
+		if through is None:
+			return []
+		before = min(before, through) if before is not None else through
+		result = []
+		for path in glob.glob(os.path.join(self.root, '*', '*', '*.npz')):
+			day = date.fromisoformat(os.path.basename(path)[:-4])
+			start, end = day_range(day)
+			if start < before and (after is None or end > after):
+				result.append(day)
+		return sorted(result)
+
+	def load(self, day: date) -> Columns:
+		with np.load(self.path(day)) as data:
+			return data['recorded_at'], data['sensor_id'], data['temperature']
+
+	def write(self, day: date, columns: Columns):
+		"""Stores the readings of `day`, merged with whatever an earlier run archived for it."""
+		path = self.path(day)
+		if os.path.exists(path):
+			columns = tuple(np.concatenate(pair) for pair in zip(self.load(day), columns))
+		recorded_at, sensor_id, temperature = columns
+		order = np.lexsort((sensor_id, recorded_at))
+		recorded_at, sensor_id, temperature = recorded_at[order], sensor_id[order], temperature[order]
+		keep = np.ones(len(order), dtype=bool)
+		keep[1:] = (recorded_at[1:] != recorded_at[:-1]) | (sensor_id[1:] != sensor_id[:-1])
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		temporary = path[:-4] + '.tmp.npz'
+		np.savez_compressed(temporary, recorded_at=recorded_at[keep], sensor_id=sensor_id[keep], temperature=temperature[keep])
+		os.replace(temporary, path)
+
+	def mark(self, through: datetime):
+		os.makedirs(self.root, exist_ok=True)
+		with open(self.state + '.tmp', 'w') as file:
+			json.dump({'through': through.isoformat()}, file)
+		os.replace(self.state + '.tmp', self.state)
+
+	def iter_read(self, sensor_ids: Optional[Iterable[int]] = None, after: Optional[datetime] = None,
+				  before: Optional[datetime] = None, descending: bool = False) -> Iterator[Columns]:
+		"""The readings of `read`, one archived day at a time."""
+		through = self.through
+		if through is None:
+			return
+		before = min(before, through) if before is not None else through
+		days = self.days(after, before)
+		if descending:
+			days.reverse()
+		ids = np.fromiter(sensor_ids, dtype=np.int64) if sensor_ids is not None else None
+		limit = np.datetime64(before)
+		for day in days:
+			recorded_at, sensor_id, temperature = self.load(day)
+			mask = recorded_at < limit
+			if after is not None:
+				mask &= recorded_at > np.datetime64(after)
+			if ids is not None:
+				mask &= np.isin(sensor_id, ids)
+			if mask.any():
+				yield recorded_at[mask], sensor_id[mask], temperature[mask]
+
+	def read(self, sensor_ids: Optional[Iterable[int]] = None, after: Optional[datetime] = None,
+			 before: Optional[datetime] = None, descending: bool = False, stamps: Optional[int] = None) -> Columns:
+		"""Readings in (after, before) sorted by recorded_at.
+
+		With `stamps` whole days are read, starting from the end the result is
+		ordered by, only until that many distinct timestamps are found.
+		"""
+		parts = []
+		found = 0
+		for columns in self.iter_read(sensor_ids, after, before, descending):
+			parts.append(columns)
+			found += len(np.unique(columns[0]))
+			if stamps is not None and found >= stamps:
+				break
+		if not parts:
+			return empty()
+		if descending:
+			parts.reverse()
+		return tuple(np.concatenate(column) for column in zip(*parts))
+
+	def span(self, sensor_ids: Optional[Iterable[int]] = None, after: Optional[datetime] = None,
+			 before: Optional[datetime] = None) -> Tuple[Optional[datetime], Optional[datetime]]:
+		"""First and last archived timestamps in (after, before)."""
+		first = self.read(sensor_ids, after, before, stamps=1)[0]
+		if not len(first):
+			return None, None
+		last = self.read(sensor_ids, after, before, descending=True, stamps=1)[0]
+		return first[0].astype(datetime), last[-1].astype(datetime)
+
+
+def export_day(store: ArchiveStore, day: date) -> int:
+	"""Copies the table rows of `day` into the archive on a session of its own."""
+	start, end = day_range(day)
+	db = SessionLocal()
+	try:
+		rows = db.query(Temperature.recorded_at, Temperature.sensor_id, Temperature.temperature) \
+			.filter(Temperature.recorded_at >= start, Temperature.recorded_at < end).all()
+	finally:
+		db.close()
+	if rows:
+		recorded_at, sensor_id, temperature = zip(*rows)
+		store.write(day, (np.array(recorded_at, dtype='datetime64[us]'), np.array(sensor_id, dtype=np.int64),
+						  np.array([np.nan if value is None else value for value in temperature], dtype=np.float64)))
+	return len(rows)
+
+
+def delete_day(db: Session, day: date) -> int:
+	start, end = day_range(day)
+	return db.query(Temperature) \
+		.filter(Temperature.recorded_at >= start, Temperature.recorded_at < end) \
+		.delete(synchronize_session=False)
+
+
+async def retain(store: ArchiveStore, days: int = RETENTION_DAYS, today: Optional[date] = None) -> int:
+	"""Moves every whole day older than `days` days from the table to the archive.
+
+	Compression runs on the default executor and the deletes go through the
+	database writer, so the event loop only waits for the commits.
+	"""
+	cutoff = (today or datetime.utcnow().date()) - timedelta(days=days)
+	first = get_db().query(func.min(Temperature.recorded_at)).scalar()
+	if first is None or first.date() >= cutoff:
+		return 0
+	loop = asyncio.get_event_loop()
+	moved = 0
+	day = first.date()
+	while day < cutoff:
+		count = await loop.run_in_executor(None, export_day, store, day)
+		await writer.submit(lambda db, day=day: delete_day(db, day))
+		store.mark(day_range(day)[1])
+		log(f'ARCHIVED::{day} {count} readings', verbose=1)
+		moved += count
+		day += timedelta(days=1)
+	return moved
+
+
+async def retain_forever(store: ArchiveStore):
+	while True:
+		try:
+			await retain(store)
+		except Exception as e:
+			log('RETENTION FAILED::', e)
+		await asyncio.sleep(RETENTION_INTERVAL)
+
+
+archive = ArchiveStore()
+
+
+if __name__ == '__main__':
+	create_tables()
+	print(f'Archived {asyncio.run(retain(archive))} readings')
+	get_db().execute('VACUUM')
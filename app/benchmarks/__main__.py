@@ -0,0 +1,3 @@
+from app.benchmarks.pipeline import main
+
+main()
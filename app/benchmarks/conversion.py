@@ -0,0 +1,45 @@
+import random
+import time
+
+import numpy as np
+
+from app.benchmarks.registry import SIZES, make_fixtures
+from app.conversion import RtdConverter
+from app.processing import Readers
+from app.registry import Registry
+from app.serial_port_simulator import rtd_from_temp
+
+CYCLES = 20
+
+
+def bench(count: int) -> dict:
+	sensors, relays = make_fixtures(count)
+	for sensor in sensors:
+		sensor.wire_resistance = round(random.random(), 2)
+		sensor.correction_resistance = round(random.random() - 0.5, 2)
+	registry = Registry()
+	registry.load(sensors, relays)
+	converter = RtdConverter(registry)
+	pins = [sensor.pin for sensor in sensors]
+	rtd = [rtd_from_temp(sensor, random.uniform(-30, 60)) for sensor in sensors]
+
+	start = time.perf_counter()
+	for _ in range(CYCLES):
+		scalar = [Readers._temp_from_rtd(value, sensor) for value, sensor in zip(rtd, sensors)]
+	scalar_time = (time.perf_counter() - start) / CYCLES
+
+	start = time.perf_counter()
+	for _ in range(CYCLES):
+		_, _, _, vector = converter.convert(pins, rtd)
+	vector_time = (time.perf_counter() - start) / CYCLES
+
+	error = float(np.max(np.abs(np.array(scalar) - vector)))
+	assert error <= 0.1, error
+	return {'sensors': count, 'scalar_ms': scalar_time * 1000, 'vector_ms': vector_time * 1000, 'max_error': error}
+
+
+if __name__ == '__main__':
+	for size in SIZES:
+		row = bench(size)
+		print(f"{row['sensors']:>5} sensors: scalar {row['scalar_ms']:8.3f} ms, "
+			  f"vectorized {row['vector_ms']:8.3f} ms, max error {row['max_error']:.2f} °C")
@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, Session
+
+from app.benchmarks import conversion
+from app.benchmarks.registry import FramePort, dry_relays, make_fixtures
+from app.database import Base
+from app.helpers import get_temps, group_temps, iter_export
+from app.models import House, Sensor, Temperature
+from app.persistence import BucketWriter
+from app.processing import Readers
+from app.exporter import FORMATS, pa, save_to_excel, stream_to_excel
+from app.serial_port_simulator import rtd_from_temp
+from app.settings import BUCKET_MINUTES
+from app.validators.Download import InputValidator
+from app.writer import DatabaseWriter
+
+END_DATE = datetime(2024, 1, 1)
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+HOUSES = 3
+
+
+def measure(func: Callable, repeat: int = 3, setup: Optional[Callable] = None) -> dict:
+	timings = []
+	for _ in range(repeat):
+		args = setup() if setup else ()
+		start = time.perf_counter()
+		func(*args)
+		timings.append(time.perf_counter() - start)
+	return {'seconds': statistics.median(timings), 'min': min(timings), 'repeat': repeat}
+
+
+def peak_memory(func: Callable) -> float:
+	"""Peak Python heap of one call, in MB."""
+	tracemalloc.start()
+	try:
+		func()
+		return tracemalloc.get_traced_memory()[1] / 1e6
+	finally:
+		tracemalloc.stop()
+
+
+def build_database(path: str, rows: int, sensors: int) -> sessionmaker:
+	"""Creates (or reuses) a SQLite file with `sensors` sensors and about `rows` temperature rows."""
+	engine = create_engine(f'sqlite:///{path}', connect_args={'check_same_thread': False})
+	factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+	exists = os.path.exists(path)
+	Base.metadata.create_all(bind=engine)
+	if exists:
+		return factory
+	# Core inserts keep the fixtures out of the mapper events that feed the live registry.
+	engine.execute(House.__table__.insert(), [{'id': idx, 'label': f'House {idx}', 'boilers': 1} for idx in range(1, HOUSES + 1)])
+	fixtures, _ = make_fixtures(sensors)
+	engine.execute(Sensor.__table__.insert(), [{
+		'id': sensor.id, 'pin': sensor.pin, 'sensor_type': sensor.sensor_type, 'location': sensor.location, 'pair': sensor.pair,
+		'house_id': sensor.id % HOUSES + 1, 'high_threshold': sensor.high_threshold, 'low_threshold': sensor.low_threshold,
+		'delta': sensor.delta, 'disabled': False, 'wire_resistance': 0, 'correction_resistance': 0,
+	} for sensor in fixtures])
+
+	buckets = rows // sensors
+	start = END_DATE - timedelta(minutes=BUCKET_MINUTES * buckets)
+	connection = sqlite3.connect(path)
+	connection.execute('PRAGMA journal_mode = OFF')
+	connection.execute('PRAGMA synchronous = OFF')
+	temperatures = ((((bucket * 7 + sensor_id) % 200) / 10 + 15,
+					 (start + timedelta(minutes=BUCKET_MINUTES * bucket)).strftime(DATE_FORMAT),
+					 sensor_id)
+					for bucket in range(buckets) for sensor_id in range(1, sensors + 1))
+	connection.executemany('INSERT INTO temperature (temperature, recorded_at, sensor_id) VALUES (?, ?, ?)', temperatures)
+	connection.commit()
+	connection.close()
+	return factory
+
+
+@dry_relays()
+def bench_hot_path(count: int, data_dir: str, cycles: int) -> List[dict]:
+	sensors, relays = make_fixtures(count)
+	frame = [{'pin': sensor.pin, 'rtd': rtd_from_temp(sensor, 24.0)} for sensor in sensors]
+	readers = Readers()
+	readers.serial_port = FramePort(frame)
+	readers.registry.load(sensors, relays)
+	loop = asyncio.new_event_loop()
+	result, _ = loop.run_until_complete(readers._read())
+	params = {'sensors': count}
+	results = [
+		dict(name='readers._read', params=params, **measure(lambda: loop.run_until_complete(readers._read()), cycles)),
+		dict(name='readers._post_process', params=params,
+			 **measure(lambda: loop.run_until_complete(readers._post_process(result)), cycles)),
+	]
+
+	factory = build_database(os.path.join(data_dir, f'hot-{count}.sqlite'), 0, count)
+	db = factory()
+	readers.buckets = BucketWriter()
+	readers.writer = DatabaseWriter(db)
+	dates = iter(END_DATE + timedelta(minutes=BUCKET_MINUTES * idx) for idx in range(cycles))
+
+	def new_bucket():
+		readers.buckets.write(db, result, next(dates))
+		db.commit()
+
+	results.append(dict(name='readers._save_db.new_bucket', params=params, **measure(new_bucket, cycles)))
+	results.append(dict(name='readers._save_db.same_bucket', params=params,
+						**measure(lambda: loop.run_until_complete(readers._save_db(result)), cycles)))
+	loop.run_until_complete(readers.writer.close())
+	db.close()
+	loop.close()
+	return results
+
+
+def house_counts(db: Session) -> Dict[int, dict]:
+	houses = {house.id: house for house in db.query(House).all()}
+	counts: Dict[int, dict] = {}
+	for sensor in db.query(Sensor).order_by(Sensor.house_id.desc()).all():
+		counts.setdefault(sensor.house_id, {'count': 0, 'house': houses.get(sensor.house_id)})['count'] += 1
+	return counts
+
+
+def bench_queries(rows: int, sensors: int, data_dir: str, window_days: int, repeat: int) -> List[dict]:
+	factory = build_database(os.path.join(data_dir, f'rows-{rows}-sensors-{sensors}.sqlite'), rows, sensors)
+	params = {'rows': rows, 'sensors': sensors, 'window_days': window_days}
+	start_date = (END_DATE - timedelta(days=window_days)).isoformat() + 'Z'
+	end_date = END_DATE.isoformat() + 'Z'
+
+	def temps(db: Session, **kwargs):
+		options = dict(skip=None, limit=None, sensor_ids=None, start_date=start_date, end_date=end_date, cursor=None,
+					   resolution=None, export=False)
+		options.update(kwargs)
+		return get_temps(db, **options)
+
+	def fetch(db: Session):
+		return db.query(Temperature).filter(Temperature.recorded_at > END_DATE - timedelta(days=window_days)).all()
+
+	results = [
+		dict(name='helpers.get_temps.page', params=params,
+			 **measure(lambda db: temps(db, skip=0, limit=100, start_date=None, end_date=None), repeat, lambda: (factory(),))),
+		dict(name='helpers.get_temps.window', params=params, **measure(temps, repeat, lambda: (factory(),))),
+		# Every row of the database, so it is consumed as it streams instead of collected like get_temps does.
+		dict(name='helpers.iter_export.all', params=params,
+			 **measure(lambda db: deque(iter_export(db, None, (None, None))[1], maxlen=0), repeat, lambda: (factory(),))),
+		dict(name='helpers.group_temps.window', params=params, **measure(group_temps, repeat, lambda: (fetch(factory()),))),
+		dict(name='helpers.group_temps.window.export', params=params,
+			 **measure(lambda items: group_temps(items, export=True), repeat, lambda: (fetch(factory()),))),
+	]
+
+	db = factory()
+	items = temps(db, export=True)
+	counts = house_counts(db)
+	path = os.path.join(data_dir, 'export.xlsx')
+	results.append(dict(name='exports.save_to_excel.window', params=params,
+						**measure(lambda: asyncio.run(save_to_excel(items, counts, path)), repeat),
+						peak_mb=peak_memory(lambda: asyncio.run(save_to_excel(temps(db, export=True), house_counts(db), path)))))
+	data = InputValidator(label='bench', start_date=start_date, end_date=end_date)
+	results.append(dict(name='exports.stream_to_excel.window', params=params,
+						**measure(lambda: stream_to_excel(db, data, path), repeat),
+						peak_mb=peak_memory(lambda: stream_to_excel(db, data, path))))
+	for name, (extension, _, writer) in FORMATS.items():
+		if name == 'xlsx' or (name == 'parquet' and pa is None):
+			continue
+		path = os.path.join(data_dir, 'export' + extension)
+		results.append(dict(name=f'exports.{writer.__name__}.window', params=params,
+							**measure(lambda: writer(db, data, path), repeat),
+							peak_mb=peak_memory(lambda: writer(db, data, path)), size_mb=os.path.getsize(path) / 1e6))
+	db.close()
+	return results
+
+
+def metadata() -> dict:
+	try:
+		revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		revision = None
+	return {
+		'revision': revision,
+		'python': platform.python_version(),
+		'machine': platform.machine(),
+		'created_at': datetime.utcnow().isoformat(),
+	}
+
+
+def compare(results: List[dict], baseline_path: str):
+	with open(baseline_path) as file:
+		baseline = {(item['name'], json.dumps(item['params'], sort_keys=True)): item for item in json.load(file)['results']}
+	for item in results:
+		previous = baseline.get((item['name'], json.dumps(item['params'], sort_keys=True)))
+		if previous is None or not previous.get('seconds'):
+			continue
+		print(f"{item['name']:<40} {json.dumps(item['params'], sort_keys=True):<55} "
+			  f"{previous['seconds'] * 1000:10.2f} ms -> {item['seconds'] * 1000:10.2f} ms "
+			  f"({item['seconds'] / previous['seconds']:.2f}x)", file=sys.stderr)
+
+
+def main(argv: Optional[List[str]] = None):
+	parser = argparse.ArgumentParser(description='Benchmarks the reader pipeline and the temperature queries.')
+	parser.add_argument('--rows', type=int, nargs='*', default=[10_000, 1_000_000, 10_000_000])
+	parser.add_argument('--sensors', type=int, nargs='*', default=[50, 500, 5000])
+	parser.add_argument('--db-sensors', type=int, default=50, help='sensors in the synthetic temperature databases')
+	parser.add_argument('--window-days', type=int, default=7)
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--cycles', type=int, default=20)
+	parser.add_argument('--data-dir', help='keeps the synthetic databases between runs')
+	parser.add_argument('--output', help='write results to this file instead of stdout')
+	parser.add_argument('--compare', help='print timings relative to a previous results file')
+	args = parser.parse_args(argv)
+
+	data_dir = args.data_dir or tempfile.mkdtemp(prefix='pyduino-bench-')
+	os.makedirs(data_dir, exist_ok=True)
+	results = []
+	for count in args.sensors:
+		print(f'hot path, {count} sensors', file=sys.stderr)
+		results.extend(bench_hot_path(count, data_dir, args.cycles))
+		row = conversion.bench(count)
+		results.append({'name': 'conversion.frame', 'params': {'sensors': count}, 'seconds': row['vector_ms'] / 1000,
+						'scalar_seconds': row['scalar_ms'] / 1000, 'max_error': row['max_error']})
+	for rows in args.rows:
+		print(f'queries, {rows} rows', file=sys.stderr)
+		results.extend(bench_queries(rows, args.db_sensors, data_dir, args.window_days, args.repeat))
+
+	if args.compare:
+		compare(results, args.compare)
+	report = json.dumps({'metadata': metadata(), 'results': results}, indent=2)
+	if args.output:
+		with open(args.output, 'w') as file:
+			file.write(report)
+	else:
+		print(report)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,117 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import List, Tuple
+
+from app import gpio
+from app.models import Sensor, Relays
+from app.processing import Readers
+from app.serial_port_simulator import rtd_from_temp
+
+SIZES = [50, 500, 5000]
+CYCLES = 20
+GROUP = 5
+
+
+class FramePort:
+	connected: bool = True
+
+	def __init__(self, frame: List[dict]):
+		self.frame = frame
+
+	async def read(self) -> Tuple[List[dict], str]:
+		return [dict(item) for item in self.frame], ''
+
+
+class DryGPIO:
+	"""Takes the relay writes of a benchmark, so running one on a Pi never switches a relay."""
+	OUT = 'OUTPUT'
+	LOW = 'ON'
+	HIGH = 'OFF'
+
+	@classmethod
+	def setup(cls, pin, pin_type):
+		pass
+
+	@classmethod
+	def output(cls, pin, value):
+		pass
+
+
+@contextmanager
+def dry_relays():
+	real = gpio.GPIO
+	gpio.GPIO = DryGPIO
+	try:
+		yield
+	finally:
+		gpio.GPIO = real
+
+
+def make_fixtures(count: int) -> Tuple[List[Sensor], List[Relays]]:
+	sensors, relays = [], []
+	for idx in range(1, count + 1):
+		master = (idx - 1) // GROUP * GROUP + 1
+		if idx == master:
+			relays.append(Relays(id=master, pin=master, label=f'Relay {master}', disabled=False, fire_on_threshold=False))
+		sensors.append(Sensor(id=idx, pin=idx, sensor_type=1000, location='up' if idx == master else 'down',
+							  pair=None if idx == master else master, relay_id=None if idx == master else master,
+							  wire_resistance=0, correction_resistance=0, high_threshold=27, low_threshold=22,
+							  delta=3, disabled=False))
+	relays.append(Relays(id=count + 1, pin=count + 1, label='Threshold', disabled=False, fire_on_threshold=True))
+	return sensors, relays
+
+
+def linear_cycle(sensors: List[Sensor], relays: List[Relays], frame: List[dict]):
+	"""Pin and pair lookups the way the reader loop did them before the registry."""
+	readings = []
+	for item in frame:
+		sensor = next((el for el in sensors if el.pin == item['pin'] and not el.disabled), None)
+		if sensor is not None:
+			readings.append({'sensor_id': sensor.id, 'temperature': 24.0})
+	for reading in readings:
+		slave = next((el for el in sensors if el.id == reading['sensor_id'] and not el.disabled), None)
+		master = next((el for el in sensors if el.id == slave.pair and not el.disabled), None)
+		if master is None:
+			continue
+		next((el for el in readings if el['sensor_id'] == master.id), None)
+		next((el for el in relays if el.id == slave.relay_id and not el.disabled), None)
+
+
+async def registry_cycle(readers: Readers):
+	result, _ = await readers._read()
+	await readers._post_process(result)
+
+
+@dry_relays()
+def bench(count: int) -> dict:
+	sensors, relays = make_fixtures(count)
+	frame = [{'pin': sensor.pin, 'rtd': rtd_from_temp(sensor, 24.0)} for sensor in sensors]
+	readers = Readers()
+	readers.serial_port = FramePort(frame)
+	readers.registry.load(sensors, relays)
+
+	# One untimed cycle each, so neither side pays for first-use work such as building caches.
+	loop = asyncio.new_event_loop()
+	loop.run_until_complete(registry_cycle(readers))
+	linear_cycle(sensors, relays, frame)
+
+	start = time.perf_counter()
+	for _ in range(CYCLES):
+		loop.run_until_complete(registry_cycle(readers))
+	indexed = (time.perf_counter() - start) / CYCLES
+	loop.close()
+
+	cycles = max(1, CYCLES * SIZES[0] // count)
+	start = time.perf_counter()
+	for _ in range(cycles):
+		linear_cycle(sensors, relays, frame)
+	linear = (time.perf_counter() - start) / cycles
+	return {'sensors': count, 'indexed_ms': indexed * 1000, 'linear_lookups_ms': linear * 1000}
+
+
+if __name__ == '__main__':
+	for size in SIZES:
+		row = bench(size)
+		print(f"{row['sensors']:>5} sensors: full cycle {row['indexed_ms']:9.2f} ms, "
+			  f"linear lookups alone {row['linear_lookups_ms']:9.2f} ms")
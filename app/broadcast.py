@@ -0,0 +1,164 @@
+import asyncio
+import json
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Set, Union
+
+from fastapi import WebSocket
+
+from app.settings import WS_QUEUE_SIZE, log
+
+ENCODINGS = ('json', 'zlib')
+FRAME_DATE = 'date'
+
+
+class Subscription:
+	"""What a websocket client asked for: which sensors, delta frames and wire encoding.
+
+	An empty subscription receives every sensor as full JSON frames, which is
+	what `/ws` always sent.
+	"""
+
+	def __init__(self, house_ids: Optional[Set[int]] = None, sensor_ids: Optional[Set[int]] = None,
+				 delta: bool = False, encoding: str = 'json'):
+		if encoding not in ENCODINGS:
+			raise ValueError(f'Unknown encoding {encoding}')
+		self.house_ids = set(house_ids or ())
+		self.sensor_ids = set(sensor_ids or ())
+		self.delta = delta
+		self.encoding = encoding
+
+	@property
+	def plain(self) -> bool:
+		return not self.house_ids and not self.sensor_ids and not self.delta and self.encoding == 'json'
+
+	def matches(self, item: dict) -> bool:
+		if not self.house_ids and not self.sensor_ids:
+			return True
+		return item.get('house_id') in self.house_ids or item.get('sensor_id') in self.sensor_ids
+
+
+class Subscriber:
+	def __init__(self, websocket: WebSocket, subscription: Optional[Subscription] = None, size: int = WS_QUEUE_SIZE,
+				 seq: int = 0):
+		self.websocket = websocket
+		self.subscription = subscription or Subscription()
+		self.queue: asyncio.Queue = asyncio.Queue(maxsize=size)
+		self.state: Dict[int, dict] = {}
+		self.connected_at = time.time()
+		self.sent: int = 0
+		self.dropped: int = 0
+		# Lag counts from the frame the client joined at, not from the start of the stream.
+		self.last_seq: int = seq
+
+	def push(self, seq: int, frame: dict, message: str):
+		if self.queue.full():
+			self.queue.get_nowait()
+			self.dropped += 1
+		self.queue.put_nowait((seq, frame, message))
+
+	def _delta(self, data: List[dict]) -> List[dict]:
+		"""Items reduced to the fields that changed since this client's last frame.
+
+		`date` is the same for every item of a frame and changes with each one,
+		so it is left out here and sent once per frame.
+		"""
+		result = []
+		for item in data:
+			item = {key: value for key, value in item.items() if key != FRAME_DATE}
+			previous = self.state.get(item['sensor_id'])
+			self.state[item['sensor_id']] = item
+			if previous is None:
+				result.append(item)
+				continue
+			changed = {key: value for key, value in item.items() if previous.get(key) != value}
+			if changed:
+				changed['sensor_id'] = item['sensor_id']
+				result.append(changed)
+		return result
+
+	def render(self, frame: dict, message: str) -> Union[str, bytes]:
+		subscription = self.subscription
+		if subscription.plain:
+			return message
+		data = [item for item in frame['data'] if subscription.matches(item)]
+		if subscription.delta:
+			date = frame['data'][0].get(FRAME_DATE) if frame['data'] else None
+			payload = {'data': self._delta(data), 'err': frame['err'], 'delta': self.sent > 0, FRAME_DATE: date}
+		else:
+			payload = {'data': data, 'err': frame['err']}
+		text = json.dumps(payload, separators=(',', ':'))
+		if subscription.encoding == 'zlib':
+			return zlib.compress(text.encode())
+		return text
+
+	async def receive_until_closed(self):
+		"""Reads the socket until the client disconnects; messages from clients are ignored."""
+		while True:
+			message = await self.websocket.receive()
+			if message['type'] == 'websocket.disconnect':
+				return
+
+	async def send_forever(self):
+		while True:
+			seq, frame, message = await self.queue.get()
+			message = self.render(frame, message)
+			if type(message) is bytes:
+				await self.websocket.send_bytes(message)
+			else:
+				await self.websocket.send_text(message)
+			self.last_seq = seq
+			self.sent += 1
+
+
+class Broadcaster:
+	"""Fans every frame out to all websocket subscribers.
+
+	Each frame is serialized once for the clients that want everything, and
+	queued per subscriber. A subscriber that falls behind loses its oldest
+	queued frames instead of slowing the reader loop or the other clients.
+	Filtered and delta frames are rendered when they are sent, so a dropped
+	frame never leaves a delta client out of sync. Each socket is also read,
+	so a client that disconnects is dropped at once, not at the next send.
+	"""
+	seq: int = 0
+
+	def __init__(self):
+		self.subscribers: Set[Subscriber] = set()
+
+	def publish(self, frame: Any):
+		self.seq += 1
+		message = json.dumps(frame)
+		for subscriber in self.subscribers:
+			subscriber.push(self.seq, frame, message)
+
+	async def serve(self, websocket: WebSocket, subscription: Optional[Subscription] = None):
+		subscriber = Subscriber(websocket, subscription, seq=self.seq)
+		self.subscribers.add(subscriber)
+		tasks = {asyncio.ensure_future(subscriber.send_forever()), asyncio.ensure_future(subscriber.receive_until_closed())}
+		try:
+			done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				if task.exception() is not None:
+					log('WEBSOCKET CLOSED::', task.exception())
+		finally:
+			for task in tasks:
+				task.cancel()
+			self.subscribers.discard(subscriber)
+
+	def stats(self) -> List[dict]:
+		return [{
+			'client': f'{item.websocket.client.host}:{item.websocket.client.port}' if item.websocket.client else None,
+			'connected_at': item.connected_at,
+			'house_ids': sorted(item.subscription.house_ids),
+			'sensor_ids': sorted(item.subscription.sensor_ids),
+			'delta': item.subscription.delta,
+			'encoding': item.subscription.encoding,
+			'sent': item.sent,
+			'dropped': item.dropped,
+			'queued': item.queue.qsize(),
+			'lag': self.seq - item.last_seq,
+		} for item in self.subscribers]
+
+
+broadcaster = Broadcaster()
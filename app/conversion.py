@@ -0,0 +1,78 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.registry import Registry
+from app.settings import RTD_A, RTD_B
+
+Z1 = -RTD_A
+Z2 = RTD_A * RTD_A - (4 * RTD_B)
+Z4 = 2 * RTD_B
+
+
+class RtdConverter:
+	"""Converts a whole frame of raw `rtd` readings to resistance and temperature.
+
+	Per-sensor coefficients are gathered into arrays once per registry version,
+	so a frame is converted with a handful of NumPy operations instead of
+	recomputing the Callendar–Van Dusen constants for every reading.
+	"""
+	version: int = -1
+
+	def __init__(self, registry: Registry):
+		self.registry = registry
+		self.index: Dict[Tuple[Optional[str], int], int] = {}
+		# The port each sensor without a port of its own was first read on, until that port goes away.
+		self.bound: Dict[int, str] = {}
+		self.ids: List[int] = []
+		self.labels: List[str] = []
+		self.house_ids: List[int] = []
+		self.ref_resistor = np.empty(0)
+		self.offset = np.empty(0)
+		self.z3 = np.empty(0)
+
+	def refresh(self):
+		if self.version == self.registry.version:
+			return
+		sensors = [item for item in self.registry.active_sensors() if item.pin is not None]
+		nominal = np.array([item.sensor_type for item in sensors], dtype=np.float64)
+		self.index = {(item.port, item.pin): idx for idx, item in enumerate(sensors)}
+		self.ids = [item.id for item in sensors]
+		self.labels = [item.label for item in sensors]
+		self.house_ids = [item.house_id for item in sensors]
+		self.ref_resistor = 430 * (nominal / 100)
+		self.offset = np.array([(item.wire_resistance or 0) + (item.correction_resistance or 0) for item in sensors], dtype=np.float64)
+		self.z3 = (4 * RTD_B) / nominal
+		self.bound = {}
+		self.version = self.registry.version
+
+	def release(self, port: str):
+		"""Lets the sensors bound to `port` match on whichever port reads them next."""
+		self.bound = {pk: bound for pk, bound in self.bound.items() if bound != port}
+
+	def convert(self, pins: List[int], rtd: List[float],
+				ports: Optional[List[Optional[str]]] = None) -> Tuple[List[int], List[int], np.ndarray, np.ndarray]:
+		"""Returns positions of the known pins in the input, their coefficient rows, resistance and temperature.
+
+		A sensor without a port matches its pin on the first port it is seen on
+		and is ignored on the others, so it never gets two readings per frame,
+		until that port is released or the registry changes.
+		"""
+		self.refresh()
+		positions, rows = [], []
+		for position, pin in enumerate(pins):
+			port = ports[position] if ports is not None else None
+			row = self.index.get((port, pin))
+			if row is None and port is not None:
+				row = self.index.get((None, pin))
+				if row is not None and self.bound.setdefault(self.ids[row], port) != port:
+					row = None
+			if row is not None and rtd[position] is not None:
+				positions.append(position)
+				rows.append(row)
+		index = np.array(rows, dtype=np.int64)
+		values = np.array([rtd[position] for position in positions], dtype=np.float64)
+		resistance = self.ref_resistor[index] * values / 32768 + self.offset[index]
+		with np.errstate(invalid='ignore'):
+			temperature = np.round((np.sqrt(Z2 + self.z3[index] * resistance) + Z1) / Z4, 1)
+		return positions, rows, resistance, temperature
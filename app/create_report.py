@@ -6,17 +6,20 @@ import asyncio
 from sqlalchemy import desc, func
 
 from app.helpers import get_temps
-from app.models import House, Sensor
+from app.models import House, Sensor, create_tables
 from app.database import get_db
 from app.settings import BASE_DIR, DOWNLOADS_DIR
-from app.routes.exports import save_to_excel
+from app.exporter import save_to_excel
 
+create_tables()
 db = get_db()
 items = get_temps(db, sensor_ids=None,
 				  start_date=None,
 				  end_date=None,
 				  limit=None,
-				  skip=None, export=True)
+				  skip=None,
+				  cursor=None,
+				  resolution=None, export=True)
 
 if not os.path.exists(os.path.join(BASE_DIR, DOWNLOADS_DIR)):
 	os.mkdir(os.path.join(BASE_DIR, DOWNLOADS_DIR))
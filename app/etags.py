@@ -0,0 +1,69 @@
+import threading
+import uuid
+from collections import defaultdict
+from typing import Dict, Iterable, Optional
+
+from fastapi import Request, Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from app.database import SessionLocal
+from app.models import Sensor, Relays, House
+
+CHANGED_TABLES = 'changed_tables'
+
+
+class TableVersions:
+	"""Counts committed changes per table, so list endpoints can answer
+	If-None-Match without a query.
+
+	Mapper events mark the tables a session touched and `after_commit` bumps
+	them. The boot token makes tags from before a restart stale.
+	"""
+
+	def __init__(self):
+		self.boot = uuid.uuid4().hex[:8]
+		self.counts: Dict[str, int] = defaultdict(int)
+		self.lock = threading.Lock()
+
+	def bump(self, tables: Iterable[str]):
+		with self.lock:
+			for table in tables:
+				self.counts[table] += 1
+
+	def etag(self, *tables: str) -> str:
+		return 'W/"' + '-'.join([self.boot, *(f'{table}.{self.counts[table]}' for table in tables)]) + '"'
+
+
+versions = TableVersions()
+
+
+def check_etag(request: Request, response: Response, *tables: str) -> Optional[Response]:
+	"""A 304 response if the client already holds the current version of `tables`, else sets the ETag header."""
+	tag = versions.etag(*tables)
+	matches = {item.strip() for item in request.headers.get('if-none-match', '').split(',')}
+	if tag in matches or '*' in matches:
+		return Response(status_code=304, headers={'ETag': tag})
+	response.headers['ETag'] = tag
+	return None
+
+
+def mark_changed(mapper, connection, instance):
+	session = object_session(instance)
+	if session is not None:
+		session.info.setdefault(CHANGED_TABLES, set()).add(mapper.local_table.name)
+
+
+for model in (Sensor, Relays, House):
+	for name in ('after_insert', 'after_update', 'after_delete'):
+		event.listen(model, name, mark_changed)
+
+
+@event.listens_for(SessionLocal, 'after_commit')
+def bump_changed(session: Session):
+	versions.bump(session.info.pop(CHANGED_TABLES, ()))
+
+
+@event.listens_for(SessionLocal, 'after_rollback')
+def forget_changed(session: Session):
+	session.info.pop(CHANGED_TABLES, None)
@@ -0,0 +1,173 @@
+import glob
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.helpers import Window, literal_ids, window_criteria
+from app.models import House, Sensor
+from app.rollups import bucket_of, get_resolution, period_start
+from app.settings import BASE_DIR, DOWNLOADS_DIR, EXPORT_CACHE_MB, EXPORT_WRITER, BUCKET_MINUTES
+
+TEMPORARY = '.tmp'
+# A temporary file this old belongs to a worker that died, not to a running export.
+ABANDONED_AFTER = 24 * 3600
+
+
+def closed_window(window: Window, resolution: Optional[str], now: Optional[datetime] = None) -> bool:
+	"""Whether no reading, rollup or not, can still be added to `window`.
+
+	Raw rows are written into the current bucket and a bucket's hour and day
+	are rolled up once the next one opens, so everything before the previous
+	bucket is final.
+	"""
+	start, end = window
+	if end is None:
+		return False
+	model, period_format, delta = get_resolution(resolution)
+	limit = bucket_of(now or datetime.utcnow()) - timedelta(minutes=BUCKET_MINUTES)
+	if period_format is None:
+		return end <= limit
+	last = end - timedelta(microseconds=1)
+	return period_start(last, resolution) + delta <= limit
+
+
+def metadata_version(db: Session) -> str:
+	"""A digest of everything besides the readings that ends up in an export file."""
+	sensors = db.query(Sensor.id, Sensor.pin, Sensor.location, Sensor.label, Sensor.disabled, Sensor.house_id,
+					   Sensor.high_threshold, Sensor.low_threshold).order_by(Sensor.id).all()
+	houses = db.query(House.id, House.label).order_by(House.id).all()
+	payload = json.dumps([[list(row) for row in sensors], [list(row) for row in houses]], default=str)
+	return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def data_version(db: Session, sensor_ids: Optional[Iterable[int]], window: Window, resolution: Optional[str]) -> list:
+	"""Row count and highest id of the readings in the window.
+
+	Rollups are recomputed by deleting and inserting their rows, so a period
+	rolled up late, e.g. after a restart, changes both; so does any reading
+	added to a range that was taken for closed.
+	"""
+	model, _, _ = get_resolution(resolution)
+	query = db.query(func.count(model.id), func.max(model.id)).filter(*window_criteria(model, window))
+	if sensor_ids:
+		query = query.filter(model.sensor_id.in_(literal_ids(sensor_ids)))
+	return list(query.one())
+
+
+class ExportCache:
+	"""Export files in the downloads directory, named after what they contain.
+
+	The file of a closed range is named by `key`, so a repeated request finds
+	the file a previous one wrote. Files are written to a temporary name and
+	renamed, hence an existing file is always complete. `evict` keeps the
+	directory under `quota` bytes by removing the files used least recently;
+	serving a file counts as using it.
+	"""
+
+	def __init__(self, directory: str = DOWNLOADS_DIR, quota: int = EXPORT_CACHE_MB * 2 ** 20):
+		self.directory = directory
+		self.quota = quota
+		self.hits: int = 0
+		self.misses: int = 0
+		self.evicted: int = 0
+
+	def key(self, db: Session, sensor_ids: Optional[Iterable[int]], window: Window, resolution: Optional[str],
+			extension: str, now: Optional[datetime] = None) -> Optional[str]:
+		"""The content hash of an export, or None if its range is still open.
+
+		It covers the request, the metadata written into the file and the
+		`data_version` of the window.
+		"""
+		if not closed_window(window, resolution, now):
+			return None
+		start, end = window
+		payload = json.dumps({
+			'sensor_ids': sorted(sensor_ids) if sensor_ids else None,
+			'start': start.isoformat() if start else None,
+			'end': end.isoformat(),
+			'resolution': resolution or 'raw',
+			'format': extension,
+			'writer': EXPORT_WRITER,
+			'version': metadata_version(db),
+			'data': data_version(db, sensor_ids, window, resolution),
+		}, sort_keys=True)
+		return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+	def filename(self, key: str, extension: str) -> str:
+		return os.path.join(self.directory, key + extension)
+
+	def temporary(self, path: str, token: str) -> str:
+		"""Where an export of `path` is written before it is renamed; it keeps the extension writers check."""
+		root, name = os.path.split(path)
+		stem, extension = name.split('.', 1)
+		return os.path.join(root, f'{stem}.{token}{TEMPORARY}.{extension}')
+
+	def lookup(self, filename: str) -> bool:
+		path = os.path.join(BASE_DIR, filename)
+		if not os.path.exists(path):
+			self.misses += 1
+			return False
+		self.hits += 1
+		self.touch(filename)
+		return True
+
+	def touch(self, filename: str):
+		try:
+			os.utime(os.path.join(BASE_DIR, filename))
+		except FileNotFoundError:
+			pass
+
+	def files(self) -> List[Tuple[str, os.stat_result]]:
+		result = []
+		for path in glob.glob(os.path.join(BASE_DIR, self.directory, '*')):
+			try:
+				result.append((path, os.stat(path)))
+			except FileNotFoundError:
+				continue
+		return result
+
+	def evict(self, keep: Iterable[str] = ()) -> List[str]:
+		"""Removes the least recently used files until the rest fit in the quota.
+
+		Files in `keep`, the ones unfinished exports refer to, and the temporary
+		files of running exports are never removed. Returns the removed filenames,
+		relative to the base directory like `Download.filename`.
+		"""
+		keep = {os.path.join(BASE_DIR, filename) for filename in keep}
+		files = self.files()
+		total = sum(stat.st_size for path, stat in files)
+		removed = []
+		now = time.time()
+		for path, stat in sorted(files, key=lambda x: x[1].st_mtime):
+			if total <= self.quota:
+				break
+			if path in keep or (TEMPORARY in os.path.basename(path) and now - stat.st_mtime < ABANDONED_AFTER):
+				continue
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			total -= stat.st_size
+			removed.append(os.path.relpath(path, BASE_DIR))
+		self.evicted += len(removed)
+		return removed
+
+	def stats(self) -> dict:
+		files = self.files()
+		return {
+			'files': len(files),
+			'bytes': sum(stat.st_size for path, stat in files),
+			'quota': self.quota,
+			'hits': self.hits,
+			'misses': self.misses,
+			'evicted': self.evicted,
+		}
+
+
+export_cache = ExportCache()
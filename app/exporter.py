@@ -0,0 +1,293 @@
+"""Export files and the job that builds them.
+
+Export jobs run in spawned worker processes that import this module, so it
+must not import the routes, the readers or the GPIO pins.
+"""
+import csv
+import gzip
+import os
+import time
+import uuid
+from datetime import datetime
+from itertools import groupby, islice
+from operator import attrgetter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pandas as pd
+import xlsxwriter
+from sqlalchemy import desc, func
+from xlsxwriter.workbook import Workbook
+from xlsxwriter.worksheet import Worksheet
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = pq = None
+
+from app.database import SessionLocal, Session
+from app.export_cache import export_cache
+from app.helpers import (get_temps, export_readings, export_sensor_ids, parse_window, estimate_total, ordered_sensor_ids,
+						 STREAM_BATCH, SensorMeta, Reading)
+from app.models import Download, House, Sensor
+from app.rollups import get_resolution
+from app.validators.Download import InputValidator
+from app.settings import EXPORT_WRITER, CSV_COMPRESSION
+
+colors = ['#a4caff', '#ffebb8', '#f09cff', '#c5fffa', '#9bffb5', '#ecffb2', '#ffa8d5', '#cabeff']
+
+
+def add_threshold_formats(workbook: Workbook, sheet: Worksheet, first_row: int, last_row: int,
+						  thresholds: Iterable[Tuple[int, Optional[float], Optional[float]]]):
+	"""Colours readings above a column's high threshold blue and below its low threshold red.
+
+	These are Excel conditional formats, one pair of rules per column, so the
+	cells hold plain numbers and the colours follow edits.
+	"""
+	if last_row < first_row:
+		return
+	high_format = workbook.add_format({'font_color': 'blue'})
+	low_format = workbook.add_format({'font_color': 'red'})
+	for col, high_threshold, low_threshold in thresholds:
+		if high_threshold:
+			sheet.conditional_format(first_row, col, last_row, col, {'type': 'cell', 'criteria': '>',
+																	 'value': high_threshold, 'format': high_format})
+		if low_threshold:
+			sheet.conditional_format(first_row, col, last_row, col, {'type': 'cell', 'criteria': '<',
+																	 'value': low_threshold, 'format': low_format})
+
+
+async def save_to_excel(items: List[dict], house_counts: Dict[int, dict], path: str):
+	write_excel(items, house_counts, path)
+
+
+def write_excel(items: List[dict], house_counts: Dict[int, dict], path: str):
+	result = pd.ExcelWriter(path, engine='xlsxwriter')
+	thresholds: Dict[str, Tuple[Optional[float], Optional[float]]] = {}
+	values = []
+	for item in items:
+		row = {'recorded_at': item['recorded_at']}
+		for label, cell in item.items():
+			if label == 'recorded_at':
+				continue
+			row[label] = cell['temperature']
+			thresholds.setdefault(label, (cell['high_threshold'], cell['low_threshold']))
+		values.append(row)
+	df = pd.DataFrame(values).set_index('recorded_at')
+	df = df.reindex(df.index.rename('Дата'))
+	columns = list(df.columns)
+	df = pd.concat([pd.DataFrame([df.columns], index=[1], columns=df.columns), df])
+	df = pd.concat([pd.DataFrame([[]], index=[0]), df])
+	df.to_excel(result, sheet_name='Sheet1')
+	sheet: Worksheet = result.sheets['Sheet1']
+	add_threshold_formats(result.book, sheet, 3, len(df), [(col, *thresholds[label]) for col, label in
+															enumerate(columns, start=1)])
+	first_col = 0
+	for index, (house_id, meta_data) in enumerate(house_counts.items()):
+		if not meta_data['count']:
+			continue
+		color = colors[index % len(colors)]
+		merge_format = result.book.add_format({
+			'align': 'center',
+			'valign': 'vcenter',
+			'fg_color': color
+		})
+		house_format = result.book.add_format({'fg_color': color})
+		label = meta_data['house'].label if meta_data['house'] else ''
+		last_col = meta_data['count'] + first_col - 1
+		sheet.merge_range(first_row=1, first_col=first_col,
+						  last_row=1, last_col=last_col,
+						  data=label, cell_format=merge_format)
+		sheet.set_column(first_col=first_col, last_col=last_col, cell_format=house_format)
+		first_col += meta_data['count']
+	sheet.set_column(0, 0, 30)
+	result.save()
+
+
+def export_layout(db: Session, data: InputValidator) -> Tuple[Dict[int, SensorMeta], List[SensorMeta], Iterator[Reading]]:
+	"""The sensor cache, the columns of an export, one per label in export order, and its readings off the cursor."""
+	model, _, _ = get_resolution(data.resolution)
+	window = parse_window(data.start_date, data.end_date)
+	present = export_sensor_ids(db, data.sensor_ids, window, model)
+	meta, readings = export_readings(db, data.sensor_ids, window, model, present)
+	labels = set()
+	columns = []
+	for pk in sorted(present & meta.keys(), key=lambda x: meta[x].export_rank):
+		if meta[pk].label not in labels:
+			labels.add(meta[pk].label)
+			columns.append(meta[pk])
+	return meta, columns, readings
+
+
+def iter_export_rows(meta: Dict[int, SensorMeta], columns: List[SensorMeta],
+					 readings: Iterable[Reading]) -> Iterator[Tuple[datetime, List[Optional[float]]]]:
+	"""The `group_temps(export=True)` rows as a timestamp and the temperature of every column, or None."""
+	positions = {sensor.label: col for col, sensor in enumerate(columns)}
+	slots = {pk: positions[sensor.label] for pk, sensor in meta.items() if sensor.label in positions}
+	# Sensors sharing a label share a column, in which the last by export rank wins.
+	shared = len(slots) > len(columns)
+	for key, values in groupby(readings, key=attrgetter('recorded_at')):
+		row = [None] * len(columns)
+		if shared:
+			values = sorted(values, key=lambda x: meta[x.sensor_id].export_rank if x.sensor_id in meta else -1)
+		for value in values:
+			col = slots.get(value.sensor_id)
+			if col is not None:
+				row[col] = value.temperature
+		yield key, row
+
+
+def stream_to_excel(db: Session, data: InputValidator, path: str,
+					progress: Optional[Callable[[int], None]] = None) -> int:
+	"""Writes the export row by row as it comes off the cursor, with XlsxWriter in constant_memory mode.
+
+	Same layout as `write_excel`: a header row, the merged per-house band, the
+	column labels, then one row per timestamp with house colouring and
+	threshold colouring. Returns the number of rows written.
+	"""
+	meta, columns, readings = export_layout(db, data)
+	houses = {house.id: house.label for house in db.query(House).all()}
+
+	workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+	sheet = workbook.add_worksheet('Sheet1')
+	labels = [sensor.label for sensor in columns]
+	sheet.write_row(0, 0, ['Дата', *labels])
+	cell_formats = []
+	first_col = 1
+	for index, (house_id, group) in enumerate(groupby(columns, key=lambda x: x.house_id)):
+		color = colors[index % len(colors)]
+		last_col = first_col + len(list(group)) - 1
+		merge_format = workbook.add_format({'align': 'center', 'valign': 'vcenter', 'fg_color': color})
+		house_format = workbook.add_format({'fg_color': color})
+		label = houses.get(house_id, '') if house_id else ''
+		if last_col > first_col:
+			sheet.merge_range(1, first_col, 1, last_col, label, merge_format)
+		else:
+			sheet.write(1, first_col, label, merge_format)
+		sheet.set_column(first_col, last_col, None, house_format)
+		cell_formats.extend([house_format] * (last_col - first_col + 1))
+		first_col = last_col + 1
+	for col, (label, cell_format) in enumerate(zip(labels, cell_formats), start=1):
+		sheet.write(2, col, label, cell_format)
+	sheet.set_column(0, 0, 30)
+
+	date_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+	count = 0
+	for count, (recorded_at, values) in enumerate(iter_export_rows(meta, columns, readings), start=1):
+		row_index = count + 2
+		sheet.write_datetime(row_index, 0, recorded_at, date_format)
+		for col, value in enumerate(values, start=1):
+			if value is not None:
+				sheet.write_number(row_index, col, value, cell_formats[col - 1])
+		if progress is not None and count % STREAM_BATCH == 0:
+			progress(count)
+	add_threshold_formats(workbook, sheet, 3, count + 2, [(col, sensor.high_threshold, sensor.low_threshold)
+														  for col, sensor in enumerate(columns, start=1)])
+	workbook.close()
+	return count
+
+
+def write_csv(db: Session, data: InputValidator, path: str, progress: Optional[Callable[[int], None]] = None) -> int:
+	"""Writes the export as gzip compressed CSV, a date column and one column per label, straight off the cursor."""
+	meta, columns, readings = export_layout(db, data)
+	count = 0
+	with gzip.open(path, 'wt', encoding='utf-8', newline='', compresslevel=CSV_COMPRESSION) as file:
+		writer = csv.writer(file)
+		writer.writerow(['Дата', *(sensor.label for sensor in columns)])
+		for count, (recorded_at, values) in enumerate(iter_export_rows(meta, columns, readings), start=1):
+			writer.writerow([recorded_at.isoformat(sep=' '), *values])
+			if progress is not None and count % STREAM_BATCH == 0:
+				progress(count)
+	return count
+
+
+def write_parquet(db: Session, data: InputValidator, path: str,
+				  progress: Optional[Callable[[int], None]] = None) -> int:
+	"""Writes the export as Parquet, one row group per `STREAM_BATCH` rows, with the columns of `write_csv`."""
+	meta, columns, readings = export_layout(db, data)
+	schema = pa.schema([pa.field('Дата', pa.timestamp('us')),
+						*(pa.field(sensor.label, pa.float64()) for sensor in columns)])
+	rows = iter_export_rows(meta, columns, readings)
+	count = 0
+	with pq.ParquetWriter(path, schema) as writer:
+		while True:
+			batch = [[recorded_at, *values] for recorded_at, values in islice(rows, STREAM_BATCH)]
+			if not batch:
+				break
+			writer.write_table(pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in
+													 zip(zip(*batch), schema)], schema=schema))
+			count += len(batch)
+			if progress is not None:
+				progress(count)
+	return count
+
+
+FORMATS = {
+	'xlsx': ('.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', stream_to_excel),
+	'csv.gz': ('.csv.gz', 'application/gzip', write_csv),
+	'parquet': ('.parquet', 'application/vnd.apache.parquet', write_parquet),
+}
+
+
+def query_export(db: Session, data: InputValidator) -> Tuple[List[dict], Dict[int, Dict[str, Any]]]:
+	items = get_temps(db, sensor_ids=data.sensor_ids,
+					  start_date=data.start_date,
+					  end_date=data.end_date,
+					  limit=None,
+					  skip=None,
+					  cursor=None,
+					  resolution=data.resolution, export=True)
+	raw_counts: List[Tuple[Sensor, int]] = db.query(Sensor, func.count(Sensor.house_id)).filter(Sensor.disabled != True).order_by(desc(Sensor.house_id)).group_by(Sensor.house_id).all()
+	house_counts: Dict[int, Dict[str, Any]] = {}
+	for sensor, count in raw_counts:
+		house = db.query(House).get(sensor.house_id) if sensor.house_id else None
+		house_counts[sensor.house_id] = {'count': count, 'house': house}
+	return items, house_counts
+
+
+def update_download(db: Session, pk: int, **values):
+	db.query(Download).filter(Download.id == pk).update(values, synchronize_session=False)
+	db.commit()
+
+
+def build_export(pk: int, params: dict, path: str) -> int:
+	"""Runs in an export worker process and records its progress on the Download row.
+
+	Progress goes through a second session, since committing would end the
+	cursor the rows are streamed from. The file only appears at `path` once
+	it is complete.
+	"""
+	db = SessionLocal()
+	status_db = SessionLocal()
+	started = time.monotonic()
+	data = InputValidator(**params)
+	final_path, path = path, export_cache.temporary(path, uuid.uuid4().hex[:8])
+	try:
+		update_download(status_db, pk, status='running', progress=0.0)
+		if data.format in (None, 'xlsx') and EXPORT_WRITER == 'pandas':
+			items, house_counts = query_export(db, data)
+			update_download(status_db, pk, progress=0.5, row_count=len(items))
+			write_excel(items, house_counts, path)
+			count = len(items)
+		else:
+			model, _, step = get_resolution(data.resolution)
+			window = parse_window(data.start_date, data.end_date)
+			expected = estimate_total(db, ordered_sensor_ids(db, data.sensor_ids), window, model, step) or 1
+
+			def progress(count: int):
+				update_download(status_db, pk, progress=round(min(count / expected, 0.99), 2), row_count=count)
+
+			count = FORMATS[data.format or 'xlsx'][2](db, data, path, progress)
+		os.replace(path, final_path)
+		update_download(status_db, pk, status='done', progress=1.0, row_count=count,
+						duration=round(time.monotonic() - started, 3))
+		return count
+	except Exception as e:
+		db.rollback()
+		if os.path.exists(path):
+			os.remove(path)
+		update_download(status_db, pk, status='failed', error=str(e), duration=round(time.monotonic() - started, 3))
+		raise
+	finally:
+		db.close()
+		status_db.close()
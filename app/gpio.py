@@ -1,5 +1,10 @@
+import time
+from typing import Dict, List
+
 from app.settings import log
 
+RELAY_PINS = [8, 10, 12, 11, 13, 15, 16, 18]
+
 try:
 	import RPi.GPIO as GPIO
 except ImportError:
@@ -8,6 +13,7 @@ except ImportError:
 		OUT = "OUTPUT"
 		LOW = 'ON'
 		HIGH = 'OFF'
+		writes: int = 0
 
 		@classmethod
 		def setmode(cls, mode):
@@ -20,23 +26,71 @@ except ImportError:
 
 		@classmethod
 		def output(cls, pin, value):
+			cls.writes += 1
 			log(pin, value)
 
 		@classmethod
 		def cleanup(cls):
 			log('CLEANING UP GPIO')
 
-GPIO.setmode(GPIO.BOARD)
-for pin_setup in [8, 10, 12, 11, 13, 15, 16, 18]:
-	GPIO.setup(pin_setup, GPIO.OUT)
-	GPIO.output(pin_setup, GPIO.HIGH)
-
 
 class Relay:
+	"""Drives relay pins and remembers their state.
+
+	A pin is only written when its state actually changes, and a change is
+	postponed until the pin has been in its current state for `min_on` or
+	`min_off` seconds.
+	"""
+	states: Dict[int, bool] = {}
+	changed_at: Dict[int, float] = {}
+	writes: Dict[int, int] = {}
+
+	@classmethod
+	def setup(cls, pin):
+		GPIO.setup(pin, GPIO.OUT)
+		cls._write(pin, False)
+		cls.changed_at[pin] = float('-inf')
+
 	@classmethod
-	def turn_on(cls, pin):
-		GPIO.output(pin, GPIO.LOW)
+	def _write(cls, pin, on: bool):
+		GPIO.output(pin, GPIO.LOW if on else GPIO.HIGH)
+		cls.states[pin] = on
+		cls.changed_at[pin] = time.monotonic()
+		cls.writes[pin] = cls.writes.get(pin, 0) + 1
 
 	@classmethod
-	def turn_off(cls, pin):
-		GPIO.output(pin, GPIO.HIGH)
+	def set(cls, pin, on: bool, min_on: float = 0, min_off: float = 0) -> bool:
+		state = cls.states.get(pin)
+		if state == on:
+			return False
+		if state is not None:
+			dwell = (min_on if state else min_off) or 0
+			if time.monotonic() - cls.changed_at[pin] < dwell:
+				return False
+		cls._write(pin, on)
+		return True
+
+	@classmethod
+	def turn_on(cls, pin, min_on: float = 0, min_off: float = 0) -> bool:
+		return cls.set(pin, True, min_on, min_off)
+
+	@classmethod
+	def turn_off(cls, pin, min_on: float = 0, min_off: float = 0) -> bool:
+		return cls.set(pin, False, min_on, min_off)
+
+	@classmethod
+	def snapshot(cls) -> List[dict]:
+		now = time.monotonic()
+		return [{
+			'pin': pin,
+			'on': on,
+			'seconds_in_state': now - cls.changed_at[pin] if cls.changed_at[pin] != float('-inf') else None,
+			'writes': cls.writes.get(pin, 0)
+		} for pin, on in sorted(cls.states.items())]
+
+
+def setup_relays():
+	"""Switches every relay pin off; the server calls it on startup rather than on import."""
+	GPIO.setmode(GPIO.BOARD)
+	for pin in RELAY_PINS:
+		Relay.setup(pin)
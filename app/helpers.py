@@ -1,15 +1,30 @@
+import base64
+import csv
+import io
+import json
 from collections import defaultdict
-from typing import Callable, Dict, Any, List, Union, Set, Optional
+from itertools import chain, groupby, islice
+from operator import attrgetter
+from typing import Callable, Dict, Any, Iterable, Iterator, List, NamedTuple, Union, Set, Optional, Tuple
 
-from fastapi import Query, Depends
-from datetime import datetime
-from sqlalchemy import desc
+from fastapi import Query, Depends, HTTPException
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import desc, func, case, distinct, literal_column
 from sqlalchemy.orm import Session
 
-from app.database import get_db
-from app.models import Temperature
+from app.archive import archive, Columns
+from app.database import SessionLocal, get_session
+from app.models import Temperature, Sensor
+from app.rollups import get_resolution
+from app.settings import BUCKET_MINUTES
 
 LOCATIONS_MAP = {'up': 'ТВ', 'down': 'ТН', 'boiler': '', 'street': ''}
+PIVOT_MAX_COLUMNS = 500
+PAGE_SIZE = 100
+STREAM_BATCH = 1000
+
+Window = Tuple[Optional[datetime], Optional[datetime]]
 
 
 def parse_date(date: Optional[str]) -> Union[datetime, None]:
@@ -25,57 +40,436 @@ def group_by(values: list, func: Callable) -> Dict[Any, list]:
 	return dict(result)
 
 
-def group_temps(items: List[Temperature],
-				export: bool = False) -> Union[List[Dict[str, dict]], List[Dict[int, float]]]:
-	result = []
-	key: str
-	values: List[Temperature]
-	for key, values in group_by(list(items), lambda x: x.recorded_at).items():
+class SensorMeta(NamedTuple):
+	label: str
+	pin: int
+	rank: int
+	export_rank: int
+	high_threshold: Optional[float]
+	low_threshold: Optional[float]
+	house_id: Optional[int]
+
+
+class Reading(NamedTuple):
+	recorded_at: datetime
+	sensor_id: int
+	temperature: Optional[float]
+
+
+def export_label(sensor: Sensor) -> str:
+	prefix = LOCATIONS_MAP.get(sensor.location, '')
+	suffix = f"({sensor.label})" if sensor.label else ""
+	return f"{prefix}-{sensor.pin}" + suffix if prefix else sensor.label or ''
+
+
+def sensor_meta(sensors: Iterable[Sensor]) -> Dict[int, SensorMeta]:
+	"""What `group_item` needs of every sensor, read once instead of through each row's relationship.
+
+	`rank` is the pin order of the columns and `export_rank` the order of an
+	export row, grouped by house.
+	"""
+	by_pin = sorted(sensors, key=lambda x: x.pin)
+	by_house = {sensor.id: idx for idx, sensor in
+				enumerate(sorted(by_pin, key=lambda x: x.house_id or -1, reverse=True))}
+	return {sensor.id: SensorMeta(label=export_label(sensor), pin=sensor.pin, rank=idx, export_rank=by_house[sensor.id],
+								  high_threshold=sensor.high_threshold, low_threshold=sensor.low_threshold,
+								  house_id=sensor.house_id)
+			for idx, sensor in enumerate(by_pin)}
+
+
+def items_meta(items: List[Temperature]) -> Dict[int, SensorMeta]:
+	"""`sensor_meta` of the sensors of ORM items, touching each relationship once per sensor."""
+	sensors = {}
+	for value in items:
+		if value.sensor_id not in sensors:
+			sensors[value.sensor_id] = value.sensor
+	return sensor_meta(sensor for sensor in sensors.values() if sensor is not None)
+
+
+def group_item(key: datetime, values: Iterable[Reading], meta: Dict[int, SensorMeta],
+			   export: bool = False) -> Dict[Any, Any]:
+	values = [value for value in values if value.sensor_id in meta]
+	if export:
 		item = {}
-		for value in sorted(values, key=lambda x: x.sensor.pin):
-			if export:
-				prefix = LOCATIONS_MAP[value.sensor.location]
-				suffix = f"({value.sensor.label})" if value.sensor.label else ""
-				label = f"{prefix}-{value.sensor.pin}" + suffix if prefix else value.sensor.label
-				item[label] = {
-					'temperature': value.temperature,
-					'high_threshold': value.sensor.high_threshold,
-					'low_threshold': value.sensor.low_threshold,
-					'house_id': value.sensor.house_id
-				}
-			else:
-				item[value.sensor_id] = value.temperature
-		if export:
-			item = {k: v for k, v in sorted(item.items(), key=lambda x: x[1]['house_id'] or -1, reverse=True)}
-		item['recorded_at'] = key
+		for value in sorted(values, key=lambda x: meta[x.sensor_id].export_rank):
+			sensor = meta[value.sensor_id]
+			item[sensor.label] = {
+				'temperature': value.temperature,
+				'high_threshold': sensor.high_threshold,
+				'low_threshold': sensor.low_threshold,
+				'house_id': sensor.house_id
+			}
+	else:
+		item = {value.sensor_id: value.temperature for value in sorted(values, key=lambda x: meta[x.sensor_id].rank)}
+	item['recorded_at'] = key
+	return item
+
+
+def group_temps(items: List[Temperature], export: bool = False,
+				meta: Optional[Dict[int, SensorMeta]] = None) -> Union[List[Dict[str, dict]], List[Dict[int, float]]]:
+	items = list(items)
+	meta = meta if meta is not None else items_meta(items)
+	return [group_item(key, values, meta, export) for key, values in group_by(items, lambda x: x.recorded_at).items()]
+
+
+def iter_group_temps(items: Iterable[Reading], meta: Dict[int, SensorMeta],
+					 export: bool = False) -> Iterator[Dict[Any, Any]]:
+	"""`group_temps` for items already ordered by recorded_at, holding one timestamp at a time."""
+	for key, values in groupby(items, key=attrgetter('recorded_at')):
+		yield group_item(key, values, meta, export)
+
+
+def literal_ids(ids: Iterable[int]) -> list:
+	"""Integer ids written into the SQL, so a long id list never runs into SQLite's bound parameter limit."""
+	return [literal_column(str(int(pk))) for pk in ids]
+
+
+def window_criteria(model, window: Window) -> list:
+	after, before = window
+	criteria = []
+	if after is not None:
+		criteria.append(model.recorded_at > after)
+	if before is not None:
+		criteria.append(model.recorded_at < before)
+	return criteria
+
+
+def pivot_table(db: Session, sensor_ids: List[int], criteria: list, skip: Optional[int] = None,
+				limit: Optional[int] = None, ascending: bool = False, model=Temperature) -> List[Dict[Any, Any]]:
+	"""Returns one dict per timestamp mapping sensor id to temperature, newest first unless `ascending`.
+
+	Up to `PIVOT_MAX_COLUMNS` sensors are pivoted by SQLite itself; beyond that
+	plain (recorded_at, sensor_id, temperature) tuples are grouped in order.
+	"""
+	result = []
+	order_by = model.recorded_at if ascending else desc(model.recorded_at)
+	if len(sensor_ids) <= PIVOT_MAX_COLUMNS:
+		columns = [func.max(case([(model.sensor_id == pk, model.temperature)])) for pk in literal_ids(sensor_ids)]
+		query = db.query(model.recorded_at, *columns) \
+			.filter(model.sensor_id.in_(literal_ids(sensor_ids)), *criteria) \
+			.group_by(model.recorded_at) \
+			.order_by(order_by) \
+			.offset(skip).limit(limit)
+		for recorded_at, *values in query:
+			item = {pk: value for pk, value in zip(sensor_ids, values) if value is not None}
+			item['recorded_at'] = recorded_at
+			result.append(item)
+		return result
+
+	stamps = db.query(model.recorded_at) \
+		.filter(model.sensor_id.in_(literal_ids(sensor_ids)), *criteria) \
+		.distinct() \
+		.order_by(order_by) \
+		.offset(skip).limit(limit) \
+		.subquery()
+	order = {pk: idx for idx, pk in enumerate(sensor_ids)}
+	rows = db.query(model.recorded_at, model.sensor_id, model.temperature) \
+		.filter(model.sensor_id.in_(literal_ids(sensor_ids)), model.recorded_at.in_(stamps)) \
+		.order_by(order_by)
+	for recorded_at, values in groupby(rows, key=lambda row: row[0]):
+		item = {pk: value for _, pk, value in sorted(values, key=lambda row: order[row[1]])}
+		item['recorded_at'] = recorded_at
 		result.append(item)
 	return result
 
 
-def get_temps(db: Session = Depends(get_db),
+def pivot_columns(columns: Columns, sensor_ids: List[int], ascending: bool = False) -> List[Dict[Any, Any]]:
+	"""`pivot_table` for readings read from the archive."""
+	recorded_at, sensor_id, temperature = columns
+	if not len(recorded_at):
+		return []
+	ids = np.array(sensor_ids)
+	sorter = np.argsort(ids)
+	rank = sorter[np.searchsorted(ids, sensor_id, sorter=sorter)]
+	stamps = recorded_at.astype(np.int64)
+	order = np.lexsort((rank, stamps if ascending else -stamps))
+	stamps = stamps[order]
+	dates = recorded_at[order].astype(object)
+	pks = sensor_id[order].tolist()
+	values = temperature[order].tolist()
+	bounds = [0, *(np.flatnonzero(np.diff(stamps)) + 1).tolist(), len(order)]
+	result = []
+	for first, last in zip(bounds, bounds[1:]):
+		item = {pks[idx]: values[idx] for idx in range(first, last) if values[idx] == values[idx]}
+		item['recorded_at'] = dates[first]
+		result.append(item)
+	return result
+
+
+def pivot_temps(db: Session, sensor_ids: List[int], window: Window = (None, None), skip: Optional[int] = None,
+				limit: Optional[int] = None, ascending: bool = False, model=Temperature) -> List[Dict[Any, Any]]:
+	"""`pivot_table` over the live table followed, for raw readings, by the archive.
+
+	The archive only holds readings older than the table, so the two are
+	simply concatenated in the requested order.
+	"""
+	if not sensor_ids:
+		return []
+	criteria = window_criteria(model, window)
+	after, before = window
+	if model is not Temperature or not archive.days(after, before):
+		return pivot_table(db, sensor_ids, criteria, skip, limit, ascending, model)
+
+	def live(skip: Optional[int], limit: Optional[int]) -> List[Dict[Any, Any]]:
+		return pivot_table(db, sensor_ids, criteria, skip, limit, ascending, model)
+
+	def live_count() -> int:
+		return db.query(func.count(distinct(model.recorded_at))) \
+			.filter(model.sensor_id.in_(literal_ids(sensor_ids)), *criteria).scalar()
+
+	def archived(skip: Optional[int], limit: Optional[int]) -> List[Dict[Any, Any]]:
+		skip = skip or 0
+		stamps = skip + limit if limit is not None else None
+		columns = archive.read(sensor_ids, after, before, descending=not ascending, stamps=stamps)
+		return pivot_columns(columns, sensor_ids, ascending)[skip:stamps]
+
+	def archived_count() -> int:
+		return len(np.unique(archive.read(sensor_ids, after, before)[0]))
+
+	sources = [(live, live_count), (archived, archived_count)]
+	if ascending:
+		sources.reverse()
+	result = []
+	for fetch, count in sources:
+		rows = fetch(skip, limit - len(result) if limit is not None else None)
+		result.extend(rows)
+		if limit is not None and len(result) >= limit:
+			break
+		if skip:
+			skip = 0 if rows else max(0, skip - count())
+	return result
+
+
+def archived_items(sensor_ids: Iterable[int], window: Window) -> Iterator[Reading]:
+	"""Archived readings for `iter_group_temps`, newest first, loaded one day at a time."""
+	for recorded_at, sensor_id, temperature in archive.iter_read(sensor_ids, *window, descending=True):
+		for date, pk, value in zip(recorded_at[::-1].astype(object), sensor_id[::-1].tolist(),
+								   temperature[::-1].tolist()):
+			yield Reading(date, pk, None if value != value else value)
+
+
+def encode_cursor(direction: str, recorded_at: datetime) -> str:
+	return base64.urlsafe_b64encode(f'{direction}:{recorded_at.isoformat()}'.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, datetime]:
+	try:
+		direction, recorded_at = base64.urlsafe_b64decode(cursor.encode()).decode().split(':', 1)
+		if direction not in ('before', 'after'):
+			raise ValueError(direction)
+		return direction, datetime.fromisoformat(recorded_at)
+	except ValueError:
+		raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+def time_span(db: Session, sensor_ids: List[int], window: Window = (None, None),
+			  model=Temperature) -> Tuple[Optional[datetime], Optional[datetime]]:
+	"""First and last reading in the window, read from the recorded_at index and the archive.
+
+	Each end is its own `ORDER BY ... LIMIT 1` seek; MIN and MAX over
+	`sensor_id IN (...)` would scan every matching index entry instead.
+	"""
+	query = db.query(model.recorded_at).filter(model.sensor_id.in_(literal_ids(sensor_ids)), *window_criteria(model, window))
+	first = query.order_by(model.recorded_at).limit(1).scalar()
+	last = query.order_by(desc(model.recorded_at)).limit(1).scalar() if first is not None else None
+	if model is Temperature:
+		archived_first, archived_last = archive.span(sensor_ids, *window)
+		first = min(filter(None, (first, archived_first)), default=None)
+		last = max(filter(None, (last, archived_last)), default=None)
+	return first, last
+
+
+def estimate_total(db: Session, sensor_ids: List[int], window: Window = (None, None), model=Temperature,
+				   step: timedelta = timedelta(minutes=BUCKET_MINUTES)) -> int:
+	"""Number of `step` periods between the first and the last reading."""
+	first, last = time_span(db, sensor_ids, window, model)
+	if first is None:
+		return 0
+	return int((last - first) // step) + 1
+
+
+def paginate_temps(db: Session, sensor_ids: List[int], window: Window, skip: Optional[int], limit: int,
+				   cursor: Optional[str], model=Temperature, step: timedelta = timedelta(minutes=BUCKET_MINUTES)) -> Dict[str, Any]:
+	"""One page of `pivot_temps`, newest first.
+
+	Pages are addressed by cursors holding the timestamp at the edge of the
+	previous page, so every page costs the same index seek. `skip` still works
+	for old clients but uses OFFSET.
+	"""
+	if not sensor_ids:
+		return {'total': 0, 'data': [], 'next': None, 'prev': None}
+	direction, edge = decode_cursor(cursor) if cursor else ('before', None)
+	after, before = window
+	if edge is not None and direction == 'before':
+		before = min(before, edge) if before is not None else edge
+	if edge is not None and direction == 'after':
+		after = max(after, edge) if after is not None else edge
+	ascending = direction == 'after'
+	data = pivot_temps(db, sensor_ids, (after, before), skip=None if cursor else skip, limit=limit + 1,
+					   ascending=ascending, model=model)
+	more = len(data) > limit
+	data = data[:limit]
+	if ascending:
+		data.reverse()
+	has_next = more if direction == 'before' else edge is not None
+	has_prev = more if direction == 'after' else edge is not None or bool(skip)
+	return {
+		'total': estimate_total(db, sensor_ids, window, model, step),
+		'data': data,
+		'next': encode_cursor('before', data[-1]['recorded_at']) if data and has_next else None,
+		'prev': encode_cursor('after', data[0]['recorded_at']) if data and has_prev else None,
+	}
+
+
+def parse_window(start_date: Optional[str], end_date: Optional[str]) -> Window:
+	end_date = parse_date(end_date)
+	# end_date is inclusive, the window is not.
+	return parse_date(start_date), end_date + timedelta(microseconds=1) if end_date else None
+
+
+def ordered_sensor_ids(db: Session, sensor_ids: Optional[Set[int]] = None) -> List[int]:
+	"""Sensor ids in the column order of every pivot, by pin."""
+	all_sensor_ids = [pk for pk, in db.query(Sensor.id).order_by(Sensor.pin)]
+	if sensor_ids:
+		all_sensor_ids = [pk for pk in all_sensor_ids if pk in sensor_ids]
+	return all_sensor_ids
+
+
+def export_sensor_ids(db: Session, sensor_ids: Optional[Set[int]], window: Window, model=Temperature) -> Set[int]:
+	"""Sensors with at least one reading in the window, i.e. the columns of an export."""
+	query = db.query(distinct(model.sensor_id)).filter(*window_criteria(model, window))
+	if sensor_ids:
+		query = query.filter(model.sensor_id.in_(literal_ids(sensor_ids)))
+	result = {pk for pk, in query}
+	if model is Temperature:
+		for _, archived, _ in archive.iter_read(sensor_ids, *window):
+			result.update(np.unique(archived).tolist())
+	return result
+
+
+def export_readings(db: Session, sensor_ids: Optional[Set[int]], window: Window, model=Temperature,
+					present: Optional[Set[int]] = None) -> Tuple[Dict[int, SensorMeta], Iterator[Reading]]:
+	"""The sensor cache and the readings of the window, newest first, read with `yield_per`.
+
+	The cache only holds the sensors with readings in the window, `present`
+	if the caller already looked them up.
+	"""
+	if present is None:
+		present = export_sensor_ids(db, sensor_ids, window, model)
+	meta = sensor_meta(db.query(Sensor).filter(Sensor.id.in_(literal_ids(present))).all()) if present else {}
+	items = db.query(model.recorded_at, model.sensor_id, model.temperature) \
+		.filter(*window_criteria(model, window)) \
+		.order_by(desc(model.recorded_at))
+	if sensor_ids:
+		items = items.filter(model.sensor_id.in_(literal_ids(sensor_ids)))
+	items = items.yield_per(STREAM_BATCH)
+	if model is Temperature and archive.days(*window):
+		items = chain(items, archived_items(sensor_ids or meta, window))
+	return meta, items
+
+
+def iter_export(db: Session, sensor_ids: Optional[Set[int]], window: Window,
+				model=Temperature) -> Tuple[Dict[int, SensorMeta], Iterator[Dict[str, Any]]]:
+	"""The sensor cache and the `group_temps(export=True)` rows of the window, newest first."""
+	meta, items = export_readings(db, sensor_ids, window, model)
+	return meta, iter_group_temps(items, meta, export=True)
+
+
+def get_temps(db: Session = Depends(get_session),
 			  skip: Optional[int] = Query(None),
 			  limit: Optional[int] = Query(None),
 			  sensor_ids: Optional[Set[int]] = Query(None),
 			  start_date: Optional[str] = Query(None),
 			  end_date: Optional[str] = Query(None),
+			  cursor: Optional[str] = Query(None),
+			  resolution: Optional[str] = Query(None),
 			  export=False):
-	items = db.query(Temperature).order_by(desc(Temperature.recorded_at))
-	start_date = parse_date(start_date)
-	end_date = parse_date(end_date)
-	if start_date:
-		items = items.filter(Temperature.recorded_at > start_date)
-	if end_date:
-		items = items.filter(Temperature.recorded_at <= end_date)
+	try:
+		model, _, step = get_resolution(resolution)
+	except ValueError as e:
+		raise HTTPException(status_code=400, detail=str(e))
+	window = parse_window(start_date, end_date)
 
-	all_sensor_ids = {temp.sensor_id for temp in items.group_by(Temperature.sensor_id).all()}
-	if sensor_ids:
-		all_sensor_ids.intersection_update(sensor_ids)
-	items = items.filter(Temperature.sensor_id.in_(all_sensor_ids))
-	count = items.count()
-	if skip or limit:
-		skip *= len(all_sensor_ids)
-		limit *= len(all_sensor_ids)
-		result = group_temps(items.offset(skip).limit(limit).all(), export=export)
-		total: int = count // len(all_sensor_ids) if len(all_sensor_ids) else 0
-		return {'total': total, 'data': result}
-	return group_temps(items.all(), export=export)
+	if export:
+		_, rows = iter_export(db, sensor_ids, window, model)
+		return list(rows)
+
+	all_sensor_ids = ordered_sensor_ids(db, sensor_ids)
+	if skip or limit or cursor:
+		return paginate_temps(db, all_sensor_ids, window, skip, limit or PAGE_SIZE, cursor, model, step)
+	return pivot_temps(db, all_sensor_ids, window, model=model)
+
+
+def iter_pivot(db: Session, sensor_ids: List[int], window: Window, model=Temperature,
+			   step: timedelta = timedelta(minutes=BUCKET_MINUTES)) -> Iterator[Dict[Any, Any]]:
+	"""`pivot_temps` without limits, newest first.
+
+	Reads pages of `STREAM_BATCH` periods bounded on both sides, so every page
+	is an index range scan and only one page is held at a time.
+	"""
+	if not sensor_ids:
+		return
+	first, last = time_span(db, sensor_ids, window, model)
+	if first is None:
+		return
+	after, before = window
+	before = last + timedelta(microseconds=1)
+	while True:
+		lower = before - step * STREAM_BATCH
+		final = lower < first or (after is not None and lower <= after)
+		if after is not None:
+			lower = max(lower, after)
+		yield from pivot_temps(db, sensor_ids, (lower, before), model=model)
+		if final:
+			return
+		before = lower + timedelta(microseconds=1)
+
+
+def ndjson_lines(rows: Iterable[Dict[Any, Any]]) -> Iterator[str]:
+	for row in rows:
+		yield json.dumps(row, default=datetime.isoformat) + '\n'
+
+
+def csv_lines(rows: Iterable[Dict[Any, Any]], sensor_ids: List[int]) -> Iterator[str]:
+	buffer = io.StringIO()
+	writer = csv.writer(buffer)
+	writer.writerow(['recorded_at', *sensor_ids])
+	yield buffer.getvalue()
+	buffer.seek(0)
+	buffer.truncate()
+	for row in rows:
+		writer.writerow([row['recorded_at'].isoformat(), *(row.get(pk, '') for pk in sensor_ids)])
+		yield buffer.getvalue()
+		buffer.seek(0)
+		buffer.truncate()
+
+
+def stream_temps(sensor_ids: Optional[Set[int]], start_date: Optional[str], end_date: Optional[str],
+				 resolution: Optional[str], format: str = 'ndjson') -> Iterator[str]:
+	"""The rows of an unpaginated `get_temps` as NDJSON or CSV text, in chunks of `STREAM_BATCH` rows.
+
+	The generator opens its own session, since it outlives the request
+	handler, and only holds one page of rows, so memory does not grow with
+	the range.
+	"""
+	try:
+		model, _, step = get_resolution(resolution)
+	except ValueError as e:
+		raise HTTPException(status_code=400, detail=str(e))
+	window = parse_window(start_date, end_date)
+
+	def generate() -> Iterator[str]:
+		db = SessionLocal()
+		try:
+			ids = ordered_sensor_ids(db, sensor_ids)
+			rows = iter_pivot(db, ids, window, model, step)
+			lines = csv_lines(rows, ids) if format == 'csv' else ndjson_lines(rows)
+			while True:
+				chunk = ''.join(islice(lines, STREAM_BATCH))
+				if not chunk:
+					break
+				yield chunk
+		finally:
+			db.close()
+
+	return generate()
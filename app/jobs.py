@@ -0,0 +1,77 @@
+import asyncio
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+from app.settings import EXPORT_WORKERS, EXPORT_MAX_PENDING
+
+
+class JobRunner:
+	"""Runs CPU-bound jobs in worker processes, off the event loop and the GIL.
+
+	At most `workers` jobs run at once and at most `max_pending`, running or
+	queued, are accepted. Callers `reserve` a slot before anything that
+	awaits and then either `submit` the job into it or `release` it. Workers are
+	spawned rather than forked, since the server process has serial and
+	database threads, and are started on the first job.
+	"""
+
+	def __init__(self, workers: int = EXPORT_WORKERS, max_pending: int = EXPORT_MAX_PENDING):
+		self.workers = workers
+		self.max_pending = max_pending
+		self.pool: Optional[ProcessPoolExecutor] = None
+		self.pending: int = 0
+		self.completed: int = 0
+		self.failed: int = 0
+		self.broken: int = 0
+
+	def full(self) -> bool:
+		return self.pending >= self.max_pending
+
+	def reserve(self) -> bool:
+		if self.full():
+			return False
+		self.pending += 1
+		return True
+
+	def release(self):
+		self.pending -= 1
+
+	def submit(self, func: Callable, *args) -> asyncio.Future:
+		"""Runs `func` in a slot taken with `reserve`; the slot is released when it finishes."""
+		if self.pool is None:
+			self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+		future = asyncio.get_event_loop().run_in_executor(self.pool, func, *args)
+		future.add_done_callback(partial(self._done, self.pool))
+		return future
+
+	def _done(self, pool: ProcessPoolExecutor, future: asyncio.Future):
+		self.pending -= 1
+		if future.cancelled() or future.exception() is not None:
+			self.failed += 1
+		else:
+			self.completed += 1
+		if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool) and pool is self.pool:
+			# A worker died, e.g. killed for memory. The pool refuses every later job, so the next one starts a new pool.
+			self.broken += 1
+			self.shutdown()
+
+	def shutdown(self):
+		if self.pool is not None:
+			self.pool.shutdown(wait=False)
+			self.pool = None
+
+	def stats(self) -> dict:
+		return {
+			'workers': self.workers,
+			'max_pending': self.max_pending,
+			'pending': self.pending,
+			'completed': self.completed,
+			'failed': self.failed,
+			'broken': self.broken,
+		}
+
+
+export_jobs = JobRunner()
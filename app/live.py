@@ -0,0 +1,130 @@
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from app.settings import LIVE_HOURS, LIVE_RATE
+
+INITIAL_SLOTS = 64
+
+
+class LiveBuffer:
+	"""The last `hours` of every reading, at full resolution, in fixed memory.
+
+	Frames share one ring of timestamps; temperatures are a (sensor slot x
+	frame) float32 matrix in which a sensor missing from a frame is NaN. The
+	ring holds `hours * 3600 * rate` frames, so a controller reporting faster
+	than `rate` frames per second gets a shorter history instead of more memory.
+	A sensor missing from every frame of the ring gives its slot back, so the
+	matrix is sized by the sensors of the last `hours`, not every one ever seen.
+	"""
+
+	def __init__(self, hours: float = LIVE_HOURS, rate: float = LIVE_RATE):
+		self.capacity = max(int(hours * 3600 * rate), 1)
+		self.stamps = np.zeros(self.capacity, dtype=np.float64)
+		self.values = np.full((INITIAL_SLOTS, self.capacity), np.nan, dtype=np.float32)
+		self.slots: Dict[int, int] = {}
+		self.free: List[int] = []
+		# Sensor id -> number of the last frame it was in.
+		self.seen: Dict[int, int] = {}
+		self.frames: int = 0
+		self.head: int = -1
+		self.size: int = 0
+
+	def _slot(self, sensor_id: int) -> int:
+		slot = self.slots.get(sensor_id)
+		if slot is not None:
+			return slot
+		if self.free:
+			slot = self.free.pop()
+			self.slots[sensor_id] = slot
+			return slot
+		slot = len(self.slots)
+		if slot == len(self.values):
+			grown = np.full((len(self.values) * 2, self.capacity), np.nan, dtype=np.float32)
+			grown[:len(self.values)] = self.values
+			self.values = grown
+		self.slots[sensor_id] = slot
+		return slot
+
+	def _release(self):
+		"""Frees the slots of sensors whose readings have all left the ring; their rows are all NaN by now."""
+		expired = [pk for pk, frame in self.seen.items() if self.frames - frame >= self.capacity]
+		for pk in expired:
+			self.free.append(self.slots.pop(pk))
+			del self.seen[pk]
+
+	def push(self, readings: List[dict], stamp: Optional[float] = None):
+		self.frames += 1
+		self.head = (self.head + 1) % self.capacity
+		if self.head == 0:
+			self._release()
+		self.size = min(self.size + 1, self.capacity)
+		self.stamps[self.head] = stamp if stamp is not None else time.time()
+		self.values[:, self.head] = np.nan
+		if readings:
+			slots = [self._slot(item['sensor_id']) for item in readings]
+			self.values[slots, self.head] = [item['temperature'] for item in readings]
+			for item in readings:
+				self.seen[item['sensor_id']] = self.frames
+
+	def _window(self, seconds: Optional[float], end: Optional[float]) -> np.ndarray:
+		"""Ring positions of the frames in (end - seconds, end], oldest first."""
+		order = (np.arange(self.head - self.size + 1, self.head + 1)) % self.capacity
+		stamps = self.stamps[order]
+		end = end if end is not None else (stamps[-1] if self.size else 0)
+		mask = stamps <= end
+		if seconds is not None:
+			mask &= stamps > end - seconds
+		return order[mask]
+
+	def window(self, sensor_ids: Optional[Iterable[int]] = None, seconds: Optional[float] = None,
+			   end: Optional[float] = None, step: Optional[float] = None) -> Dict[int, dict]:
+		"""Readings per sensor, averaged over `step` seconds if given, with min/max/mean/last of the window."""
+		positions = self._window(seconds, end)
+		ids = [pk for pk in (sensor_ids if sensor_ids is not None else self.slots) if pk in self.slots]
+		result = {}
+		if not len(positions) or not ids:
+			return result
+		stamps = self.stamps[positions]
+		values = self.values[np.ix_([self.slots[pk] for pk in ids], positions)]
+		aggregates = {}
+		for pk, row in zip(ids, values):
+			readings = row[~np.isnan(row)]
+			if len(readings):
+				aggregates[pk] = {
+					'min': round(float(readings.min()), 2),
+					'max': round(float(readings.max()), 2),
+					'mean': round(float(readings.mean()), 2),
+					'last': round(float(readings[-1]), 2),
+					'count': len(readings),
+				}
+		if step:
+			buckets = np.floor(stamps / step)
+			starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+			stamps = buckets[starts] * step
+			present = ~np.isnan(values)
+			counts = np.add.reduceat(present, starts, axis=1)
+			sums = np.add.reduceat(np.where(present, values, 0), starts, axis=1)
+			with np.errstate(invalid='ignore', divide='ignore'):
+				values = sums / counts
+		dates = [datetime.utcfromtimestamp(stamp) for stamp in stamps.tolist()]
+		for pk, row in zip(ids, values):
+			if pk not in aggregates:
+				continue
+			present = (~np.isnan(row)).tolist()
+			result[pk] = dict(aggregates[pk],
+							  recorded_at=[date for date, keep in zip(dates, present) if keep],
+							  temperature=np.round(row[~np.isnan(row)].astype(np.float64), 2).tolist())
+		return result
+
+	def stats(self) -> dict:
+		return {
+			'capacity': self.capacity,
+			'frames': self.size,
+			'sensors': len(self.slots),
+			'free_slots': len(self.free),
+			'bytes': self.stamps.nbytes + self.values.nbytes,
+			'oldest': datetime.utcfromtimestamp(self.stamps[(self.head - self.size + 1) % self.capacity]) if self.size else None,
+		}
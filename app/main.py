@@ -1,14 +1,33 @@
 import asyncio
 
 import random
-from fastapi import FastAPI, WebSocket
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Set
+
+from fastapi import FastAPI, WebSocket, Query
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.archive import archive, retain_forever
+from app.broadcast import broadcaster, Subscription
 from app.processing import readers
 from app.routes import spis, relays, temperatures, exports, calibration, houses
-from app.models import Sensor
-from app.gpio import GPIO
+from app.routes.exports import fail_interrupted
+from app.jobs import export_jobs
+from app.models import Sensor, create_tables
+from app.gpio import GPIO, setup_relays
 from app.database import get_db
+from app.monitor import monitor
+from app.rollups import rollup_missing
+from app.settings import DB_THREADS
+from app.writer import writer
+
+try:
+	# Newer Starlette runs sync code through anyio instead of the loop's default executor.
+	from anyio import to_thread
+except ImportError:
+	to_thread = None
+
+create_tables()
 
 app = FastAPI()
 app.include_router(spis)
@@ -29,21 +48,55 @@ app.add_middleware(
 
 @app.on_event('startup')
 async def run_reader():
+	# Sync routes and dependencies run on this pool, so it bounds concurrent database work.
+	asyncio.get_event_loop().set_default_executor(ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='db'))
+	if to_thread is not None:
+		to_thread.current_default_thread_limiter().total_tokens = DB_THREADS
+	setup_relays()
+	monitor.start()
+	fail_interrupted()
+	writer.submit(rollup_missing)
 	asyncio.create_task(readers.setup())
+	asyncio.create_task(retain_forever(archive))
 
 
 @app.on_event('shutdown')
 async def clean_gpio():
 	GPIO.cleanup()
+	export_jobs.shutdown()
+	await writer.close()
 
 
 @app.websocket('/ws')
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket,
+							 house_id: Optional[Set[int]] = Query(None),
+							 sensor_ids: Optional[Set[int]] = Query(None),
+							 delta: bool = False,
+							 encoding: str = 'json'):
 	await websocket.accept()
-	while True:
-		data, err = await readers.read_from_stream()
-		try:
-			await websocket.send_json({'data': data, 'err': err})
-		except Exception as e:
-			print(e)
-			return
+	try:
+		subscription = Subscription(house_ids=house_id, sensor_ids=sensor_ids, delta=delta, encoding=encoding)
+	except ValueError:
+		await websocket.close(code=1008)
+		return
+	await broadcaster.serve(websocket, subscription)
+
+
+@app.get('/ws/stats')
+async def websocket_stats():
+	return broadcaster.stats()
+
+
+@app.get('/serial/stats')
+async def serial_stats():
+	return readers.serial_port.stats()
+
+
+@app.get('/db/stats')
+async def database_stats():
+	return writer.stats()
+
+
+@app.get('/loop/stats')
+async def loop_stats():
+	return monitor.stats()
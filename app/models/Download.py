@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, Float
 from datetime import datetime
 
 from app.database import Base
@@ -11,3 +11,9 @@ class Download(Base):
 	label = Column(String)
 	filename = Column(String)
 	created_at = Column(DateTime, default=datetime.now)
+	# Defaults describe a finished file, which is what rows from before export jobs are.
+	status = Column(String, default='done')
+	progress = Column(Float, default=1.0)
+	row_count = Column(Integer)
+	duration = Column(Float)
+	error = Column(String)
@@ -12,5 +12,7 @@ class Relays(Base):
 	pin = Column(Integer, unique=True, index=True)
 	disabled = Column(Boolean, default=False)
 	fire_on_threshold = Column(Boolean, default=False)
+	min_on = Column(Float, default=0.0)
+	min_off = Column(Float, default=0.0)
 	created_at = Column(DateTime, default=datetime.now)
 	updated_at = Column(DateTime, onupdate=datetime.now)
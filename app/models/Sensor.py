@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, DateTime, Index, func
 from sqlalchemy.orm import relationship
 from datetime import datetime
 
@@ -11,7 +11,8 @@ class Sensor(Base):
 	id = Column(Integer, primary_key=True, index=True)
 	label = Column(String)
 	sensor_type = Column(Integer, index=True)
-	pin = Column(Integer, unique=True, index=True)
+	pin = Column(Integer, index=True)
+	port = Column(String, index=True)
 	disabled = Column(Boolean, default=False)
 	relay_id = Column(Integer, ForeignKey('relays.id', ondelete='CASCADE'))
 	location = Column(String)
@@ -25,3 +26,7 @@ class Sensor(Base):
 	temperatures = relationship('Temperature', back_populates="sensor", lazy=True, cascade="all, delete-orphan")
 	created_at = Column(DateTime, default=datetime.now)
 	updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+
+# SQLite treats NULLs as distinct, so the port is coalesced for two portless sensors on one pin to collide.
+Index('ix_sensors_port_pin', func.coalesce(Sensor.port, ''), Sensor.pin, unique=True)
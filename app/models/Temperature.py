@@ -1,10 +1,11 @@
-from sqlalchemy import Column, Integer, Float, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, Float, ForeignKey, DateTime, Index
 from sqlalchemy.orm import relationship
 from app.database import Base
 
 
 class Temperature(Base):
 	__tablename__ = "temperature"
+	__table_args__ = (Index('ix_temperature_sensor_id_recorded_at', 'sensor_id', 'recorded_at'),)
 
 	id = Column(Integer, primary_key=True, index=True)
 	temperature = Column(Float)
@@ -0,0 +1,34 @@
+from sqlalchemy import Column, Integer, Float, ForeignKey, DateTime, UniqueConstraint
+from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm import relationship
+
+from app.database import Base
+
+
+class TemperatureRollup:
+	id = Column(Integer, primary_key=True, index=True)
+	recorded_at = Column(DateTime, index=True)
+	temperature = Column(Float)
+	min_temperature = Column(Float)
+	max_temperature = Column(Float)
+	count = Column(Integer)
+
+	@declared_attr
+	def sensor_id(cls):
+		return Column(Integer, ForeignKey('sensors.id', ondelete='CASCADE'))
+
+	@declared_attr
+	def sensor(cls):
+		return relationship('Sensor')
+
+	@declared_attr
+	def __table_args__(cls):
+		return (UniqueConstraint('sensor_id', 'recorded_at'),)
+
+
+class TemperatureHourly(TemperatureRollup, Base):
+	__tablename__ = "temperature_hourly"
+
+
+class TemperatureDaily(TemperatureRollup, Base):
+	__tablename__ = "temperature_daily"
@@ -1,4 +1,5 @@
 from .Temperature import Temperature
+from .TemperatureRollup import TemperatureHourly, TemperatureDaily
 from .Relays import Relays
 from .Download import Download
 from .House import House
@@ -6,6 +7,11 @@ from .Sensor import Sensor
 from .BoilerLogs import BoilerLogs
 from .Sensor import Base
 
-from app.database import engine
+from app.database import engine, add_missing_columns, add_missing_indexes
 
-Base.metadata.create_all(bind=engine)
+
+def create_tables():
+	"""Creates and migrates the tables. The server and the standalone scripts call it, export workers import the models as they are."""
+	Base.metadata.create_all(bind=engine)
+	add_missing_columns(Base.metadata)
+	add_missing_indexes(Base.metadata)
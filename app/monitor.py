@@ -0,0 +1,63 @@
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Optional
+
+from app.settings import LOOP_MONITOR_INTERVAL, LOOP_STALL_THRESHOLD
+
+WINDOW_SECONDS = 60
+
+
+class LoopMonitor:
+	"""Measures how late the event loop wakes up from a short sleep.
+
+	Any lag beyond `threshold` means some callback held the loop, which also
+	delays serial reads, relay control and websockets. Lags of the last
+	minute are kept for `stats`.
+	"""
+
+	def __init__(self, interval: float = LOOP_MONITOR_INTERVAL, threshold: float = LOOP_STALL_THRESHOLD):
+		self.interval = interval
+		self.threshold = threshold
+		self.recent: Deque[float] = deque(maxlen=int(WINDOW_SECONDS / interval))
+		self.task: Optional[asyncio.Task] = None
+		self.samples: int = 0
+		self.stalls: int = 0
+		self.stalled_seconds: float = 0
+		self.max_lag: float = 0
+
+	def start(self):
+		if self.task is None or self.task.done():
+			self.task = asyncio.ensure_future(self._run())
+
+	async def _run(self):
+		while True:
+			start = time.monotonic()
+			await asyncio.sleep(self.interval)
+			self.record(time.monotonic() - start - self.interval)
+
+	def record(self, lag: float):
+		lag = max(lag, 0)
+		self.samples += 1
+		self.recent.append(lag)
+		self.max_lag = max(self.max_lag, lag)
+		if lag > self.threshold:
+			self.stalls += 1
+			self.stalled_seconds += lag
+
+	def stats(self) -> dict:
+		recent = sorted(self.recent)
+		return {
+			'interval': self.interval,
+			'threshold': self.threshold,
+			'samples': self.samples,
+			'stalls': self.stalls,
+			'stalled_seconds': round(self.stalled_seconds, 3),
+			'max_lag': round(self.max_lag, 4),
+			'last_lag': round(self.recent[-1], 4) if recent else None,
+			'recent_p99_lag': round(recent[int(len(recent) * 0.99)], 4) if recent else None,
+			'recent_max_lag': round(recent[-1], 4) if recent else None,
+		}
+
+
+monitor = LoopMonitor()
@@ -0,0 +1,60 @@
+import math
+from datetime import datetime, timedelta
+from typing import List, Optional, Set
+
+from sqlalchemy.orm import Session
+
+from app.models import Temperature
+from app.rollups import rollup, bucket_of
+from app.settings import BUCKET_MINUTES
+
+
+class BucketWriter:
+	"""Persists the first reading of every sensor in each time bucket.
+
+	Remembers which sensors already have a row in the current bucket so that
+	repeated readings cost nothing, and writes all new rows of a cycle with a
+	single bulk INSERT. When a bucket closes its hour and day are rolled up.
+	Committing is left to the caller, normally the `DatabaseWriter` task.
+	"""
+	bucket: Optional[datetime] = None
+	# The bucket before `bucket`, whose rollup a rolled back write may have lost.
+	previous: Optional[datetime] = None
+
+	def __init__(self):
+		self.written: Set[int] = set()
+
+	def _open_bucket(self, db: Session, bucket: datetime):
+		closed = self.bucket
+		self.previous, self.bucket = closed, bucket
+		if closed is not None:
+			rollup(db, closed, closed + timedelta(minutes=BUCKET_MINUTES))
+		rows = db.query(Temperature.sensor_id).filter(Temperature.recorded_at == bucket).all()
+		self.written = {sensor_id for sensor_id, in rows}
+
+	def write(self, db: Session, data: List[dict], date: Optional[datetime] = None) -> int:
+		recorded_at = bucket_of(date or datetime.utcnow())
+		if recorded_at != self.bucket:
+			self._open_bucket(db, recorded_at)
+		rows = []
+		for item in data:
+			temperature = item.get('temperature')
+			if temperature is None or math.isnan(temperature) or item['sensor_id'] in self.written:
+				continue
+			rows.append({'sensor_id': item['sensor_id'], 'temperature': temperature, 'recorded_at': recorded_at})
+		if not rows:
+			return 0
+		db.execute(Temperature.__table__.insert(), rows)
+		self.written.update(row['sensor_id'] for row in rows)
+		return len(rows)
+
+	def forget(self, data: List[dict]):
+		"""Lets the readings of a write that was rolled back be written again.
+
+		The write may have opened the current bucket, so it is opened again,
+		rolling the one before up, by the next write. Rollups are idempotent,
+		hence doing so after a committed open is harmless.
+		"""
+		self.written.difference_update(item['sensor_id'] for item in data)
+		if self.previous is not None:
+			self.bucket = self.previous
@@ -1,64 +1,82 @@
 import asyncio
 import math
 from datetime import datetime
-from typing import List, Optional, Union, Tuple
+from typing import Callable, Dict, List, Optional, Union, Tuple
 
 import serial
 from serial.tools import list_ports
 from sqlalchemy import event, desc
+from sqlalchemy.orm import Session
 
+from app.broadcast import broadcaster
+from app.conversion import RtdConverter
 from app.database import get_db
-from app.models import Sensor, Temperature, Relays
+from app.models import Sensor, Relays
 from app.gpio import Relay
+from app.live import LiveBuffer
+from app.persistence import BucketWriter
+from app.registry import Registry
 from app.settings import BAUD_RATE, RTD_A, RTD_B, RETRY_IN
-# from app.serial_ports import SerialPortWrapper
-from app.serial_port_simulator import SerialPortWrapper
+from app.serial_ports import SerialPorts
+from app.writer import writer
+# from app.serial_ports import SerialPortWrapper, discover_ports
+from app.serial_port_simulator import SerialPortWrapper, discover_ports
 
 
 class Readers:
-	sensors: List[Sensor] = []
-	relays: List[Relays] = []
-	__value_promise: asyncio.Future = asyncio.Future()
 	__error_message: str
 	__running: bool = True
 	__current_value: List[dict] = []
 
 	def __init__(self):
 		self.db = get_db()
-		self.serial_port: SerialPortWrapper = SerialPortWrapper()
+		self.registry = Registry()
+		self.buckets = BucketWriter()
+		self.writer = writer
+		self.converter = RtdConverter(self.registry)
+		self.live = LiveBuffer()
+		self.serial_port: SerialPorts = SerialPorts(SerialPortWrapper, discover_ports, on_release=self.converter.release)
+		self.loop: Optional[asyncio.AbstractEventLoop] = None
 
 	async def setup(self):
-		self.sensors = self.db.query(Sensor).order_by(desc(Sensor.pin)).all()
-		self.relays = self.db.query(Relays).all()
+		self.loop = asyncio.get_event_loop()
+		self.registry.load(self.db.query(Sensor).order_by(desc(Sensor.pin)).all(), self.db.query(Relays).all())
 		await self.serial_port.connect_to_serial()
 		asyncio.create_task(self.run())
 
 	async def _save_db(self, data: List[dict]):
-		date = datetime.utcnow()
-		recorded_at = date.replace(minute=(date.minute // 15) * 15, second=0, microsecond=0)
-		for item in data:
-			if not item.get('temperature'):
-				return
-			instance: Optional[Temperature] = self.db.query(Temperature).filter_by(sensor_id=item['sensor_id'], recorded_at=recorded_at).one_or_none()
-			if instance is None:
-				instance = Temperature(sensor_id=item['sensor_id'], temperature=item['temperature'], recorded_at=recorded_at)
-				self.db.add(instance)
-				self.db.commit()
+		try:
+			await self.writer.submit(lambda db: self.buckets.write(db, data))
+		except Exception:
+			self.buckets.forget(data)
+
+	def sync_registry(self, func: Callable, *args):
+		"""Applies a registry change on the event loop, since routes commit from worker threads."""
+		try:
+			running = asyncio.get_running_loop()
+		except RuntimeError:
+			running = None
+		if self.loop is None or running is self.loop:
+			func(*args)
+		else:
+			self.loop.call_soon_threadsafe(func, *args)
 
 	def _get_sensor(self, pk: int) -> Union[None, Sensor]:
-		return next((item for item in self.sensors if item.id == pk and not item.disabled), None)
+		return self.registry.get_sensor(pk)
 
 	def _get_relay(self, pk: int) -> Union[None, Relays]:
-		return next((item for item in self.relays if item.id == pk and not item.disabled), None)
+		return self.registry.get_relay(pk)
 
 	def _get_threshold_relay(self):
-		return next((item for item in self.relays if item.fire_on_threshold), None)
+		return self.registry.get_threshold_relay()
 
 	async def _post_process(self, readings: List[dict]):
 		if not len(readings):
 			return
 
 		threshold_hit = []
+		relay_states: Dict[int, Tuple[Relays, bool]] = {}
+		readings_by_sensor = {item['sensor_id']: item for item in readings}
 		for sensor_reading in readings:
 			slave_sensor = self._get_sensor(sensor_reading['sensor_id'])
 
@@ -75,7 +93,7 @@ class Readers:
 			if master_sensor is None:
 				continue
 
-			pair_sensor_temp = next((item for item in readings if item['sensor_id'] == master_sensor.id), None)
+			pair_sensor_temp = readings_by_sensor.get(master_sensor.id)
 			if not pair_sensor_temp:
 				continue
 
@@ -85,10 +103,10 @@ class Readers:
 			if relay is None:
 				continue
 
-			if delta > slave_sensor.delta:
-				Relay.turn_on(relay.pin)
-			else:
-				Relay.turn_off(relay.pin)
+			relay_states[relay.id] = (relay, delta > slave_sensor.delta)
+
+		for relay, on in relay_states.values():
+			Relay.set(relay.pin, on, relay.min_on, relay.min_off)
 
 		threshold_relay = self._get_threshold_relay()
 
@@ -99,10 +117,7 @@ class Readers:
 			Relay.turn_off(threshold_relay.pin)
 			return
 
-		if any(threshold_hit):
-			Relay.turn_on(threshold_relay.pin)
-		else:
-			Relay.turn_off(threshold_relay.pin)
+		Relay.set(threshold_relay.pin, any(threshold_hit), threshold_relay.min_on, threshold_relay.min_off)
 
 	@staticmethod
 	def _temp_from_rtd(rtd: float, sensor: Sensor) -> float:
@@ -140,51 +155,60 @@ class Readers:
 		if not self.serial_port.connected:
 			await asyncio.sleep(RETRY_IN)
 			return [], 'Не возможно подключиться к датчикам'
-		sensors: List[Sensor] = [item for item in self.sensors if not item.disabled]
-		if not len(sensors):
+		self.converter.refresh()
+		if not len(self.converter.index):
 			await asyncio.sleep(2)
 			return [], 'Нет активных датчиков'
 		value: List[dict]
 		values, self.__error_message = await self.serial_port.read()
+		positions, rows, resistances, temperatures = self.converter.convert([item.get('pin') for item in values],
+																			[item.get('rtd') for item in values],
+																			[item.get('port') for item in values])
+		date = str(datetime.now())
 		result = []
-		for item in values:
-			sensor = next((el for el in sensors if el.pin == item['pin']), None)
-			if sensor is None:
+		for position, row, resistance, temperature in zip(positions, rows, resistances.tolist(), temperatures.tolist()):
+			if math.isnan(temperature):
 				continue
-			item['date'] = str(datetime.now())
-			item['sensor_id'] = sensor.id
-			item['label'] = sensor.label
-			item['temperature'] = self._temp_from_rtd(item.get('rtd'), sensor)
-			item['resistance'] = self._resistance_from_rtd(item.get('rtd'), sensor)
+			item = values[position]
+			item['date'] = date
+			item['sensor_id'] = self.converter.ids[row]
+			item['label'] = self.converter.labels[row]
+			item['house_id'] = self.converter.house_ids[row]
+			item['temperature'] = temperature
+			item['resistance'] = resistance
 			result.append(item)
 		# if DEBUG:
 		# 	print(*[{item['pin']: [item['temperature'], item['resistance']]} for item in result], sep='\n')
 		# 	print('\n' * 2)
 		return result, ''
 
-	async def read_from_stream(self) -> Tuple[List, str]:
-		result, error_message = await self.__value_promise
-		return result, error_message
-
 	async def run(self):
 		while self.__running:
 			result, error_message = await self._read()
 			self.__current_value = result.copy()
-			if self.__value_promise.done():
-				self.__value_promise = asyncio.Future()
-			self.__value_promise.set_result((result, error_message))
+			if result:
+				self.live.push(result)
+			broadcaster.publish({'data': result, 'err': error_message})
 
 			if result:
 				asyncio.create_task(self._save_db(result))
 				asyncio.create_task(self._post_process(result))
 
 	async def calibrate(self, temperature: float):
+		corrections = {}
 		for reading in self.__current_value:
 			sensor = self._get_sensor(reading['sensor_id'])
+			if sensor is None:
+				continue
 			ref_resistance = self._resistance_from_temp(temperature, sensor)
 			correction_resistance = sensor.correction_resistance or 0
-			sensor.correction_resistance = round(ref_resistance - (reading['resistance'] - correction_resistance), 2)
-		self.db.commit()
+			corrections[sensor.id] = round(ref_resistance - (reading['resistance'] - correction_resistance), 2)
+
+		def save(db: Session):
+			for sensor in db.query(Sensor).populate_existing().filter(Sensor.id.in_(corrections)):
+				sensor.correction_resistance = corrections[sensor.id]
+
+		await self.writer.submit(save)
 
 	def stop(self):
 		self.__running = False
@@ -195,40 +219,32 @@ readers = Readers()
 
 @event.listens_for(Sensor, 'after_insert')
 def add_sensor(mapper, db, instance):
-	readers.sensors.append(instance)
+	readers.sync_registry(readers.registry.add_sensor, instance)
 
 
 @event.listens_for(Sensor, 'after_update')
 def update_sensor(mapper, db, instance):
-	for idx, sensor in enumerate(readers.sensors):
-		if sensor.id == instance.id:
-			readers.sensors[idx] = instance
+	readers.sync_registry(readers.registry.update_sensor, instance)
 
 
 @event.listens_for(Sensor, 'after_delete')
 def remove_sensor(mapper, db, instance):
-	for idx, sensor in enumerate(readers.sensors):
-		if sensor.id == instance.id:
-			readers.sensors.pop(idx)
+	readers.sync_registry(readers.registry.remove_sensor, instance.id)
 
 
 @event.listens_for(Relays, 'after_insert')
 def add_relay(mapper, db, instance):
-	readers.relays.append(instance)
+	readers.sync_registry(readers.registry.add_relay, instance)
 
 
 @event.listens_for(Relays, 'after_update')
 def update_relay(mapper, db, instance):
-	for idx, relay in enumerate(readers.relays):
-		if relay.id == instance.id:
-			readers.relays[idx] = instance
+	readers.sync_registry(readers.registry.update_relay, instance)
 
 
 @event.listens_for(Relays, 'after_delete')
 def remove_relay(mapper, db, instance):
-	for idx, relay in enumerate(readers.relays):
-		if relay.id == instance.id:
-			readers.relays.pop(idx)
+	readers.sync_registry(readers.registry.remove_relay, instance.id)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,66 @@
+from typing import Dict, Iterable, List, Optional
+
+from app.models import Sensor, Relays
+
+
+class Registry:
+	"""In-memory index of sensors and relays used by the reader loop.
+
+	Sensors and relays are looked up by id in O(1); a slave finds its master
+	through `pair`, so no reverse index is kept. Pins are matched by
+	`RtdConverter`, which indexes `active_sensors` by (port, pin) again whenever
+	`version` changes, i.e. whenever a sensor is added, updated or removed.
+	"""
+
+	def __init__(self):
+		self.sensors: Dict[int, Sensor] = {}
+		self.relays: Dict[int, Relays] = {}
+		self.version = 0
+
+	def load(self, sensors: Iterable[Sensor], relays: Iterable[Relays]):
+		self.sensors.clear()
+		self.relays.clear()
+		self.version += 1
+		for sensor in sensors:
+			self.add_sensor(sensor)
+		for relay in relays:
+			self.add_relay(relay)
+
+	def add_sensor(self, sensor: Sensor):
+		self.remove_sensor(sensor.id)
+		self.version += 1
+		self.sensors[sensor.id] = sensor
+
+	def update_sensor(self, sensor: Sensor):
+		self.add_sensor(sensor)
+
+	def remove_sensor(self, pk: int):
+		self.version += 1
+		self.sensors.pop(pk, None)
+
+	def add_relay(self, relay: Relays):
+		self.relays[relay.id] = relay
+
+	def update_relay(self, relay: Relays):
+		self.add_relay(relay)
+
+	def remove_relay(self, pk: int):
+		self.relays.pop(pk, None)
+
+	def get_sensor(self, pk: Optional[int]) -> Optional[Sensor]:
+		sensor = self.sensors.get(pk)
+		if sensor is None or sensor.disabled:
+			return None
+		return sensor
+
+	def get_relay(self, pk: Optional[int]) -> Optional[Relays]:
+		relay = self.relays.get(pk)
+		if relay is None or relay.disabled:
+			return None
+		return relay
+
+	def get_threshold_relay(self) -> Optional[Relays]:
+		return next((item for item in self.relays.values() if item.fire_on_threshold), None)
+
+	def active_sensors(self) -> List[Sensor]:
+		return [item for item in self.sensors.values() if not item.disabled]
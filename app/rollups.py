@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.models import Temperature, TemperatureHourly, TemperatureDaily
+from app.settings import BUCKET_MINUTES
+
+RESOLUTIONS = {
+	'raw': (Temperature, None, timedelta(minutes=BUCKET_MINUTES)),
+	'hour': (TemperatureHourly, '%Y-%m-%d %H:00:00.000000', timedelta(hours=1)),
+	'day': (TemperatureDaily, '%Y-%m-%d 00:00:00.000000', timedelta(days=1)),
+}
+
+
+def get_resolution(resolution: Optional[str]):
+	if resolution is None:
+		resolution = 'raw'
+	if resolution not in RESOLUTIONS:
+		raise ValueError(f'Unknown resolution {resolution}')
+	return RESOLUTIONS[resolution]
+
+
+def bucket_of(date: datetime) -> datetime:
+	return date.replace(minute=(date.minute // BUCKET_MINUTES) * BUCKET_MINUTES, second=0, microsecond=0)
+
+
+def period_start(date: datetime, resolution: str) -> datetime:
+	if resolution == 'hour':
+		return date.replace(minute=0, second=0, microsecond=0)
+	return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def rollup(db: Session, start: Optional[datetime] = None, end: Optional[datetime] = None):
+	"""Recomputes the hourly and daily rows of every period overlapping [start, end).
+
+	Without bounds the whole temperature table is rolled up. Periods are
+	recomputed from the raw rows, so running it twice is harmless. Rows of
+	archived days are kept, since their raw readings left the table. The
+	caller commits.
+	"""
+	if start is None:
+		start = db.query(func.min(Temperature.recorded_at)).scalar()
+		if start is None:
+			return
+	for resolution in ('hour', 'day'):
+		model, period_format, delta = RESOLUTIONS[resolution]
+		first = period_start(start, resolution) if start is not None else None
+		last = period_start(end - timedelta(microseconds=1), resolution) + delta if end is not None else None
+		period = func.strftime(period_format, Temperature.recorded_at)
+		source = db.query(Temperature.sensor_id, period,
+						  func.round(func.avg(Temperature.temperature), 2),
+						  func.min(Temperature.temperature),
+						  func.max(Temperature.temperature),
+						  func.count(Temperature.id)) \
+			.filter(Temperature.temperature.isnot(None))
+		existing = db.query(model)
+		if first is not None:
+			source = source.filter(Temperature.recorded_at >= first)
+			existing = existing.filter(model.recorded_at >= first)
+		if last is not None:
+			source = source.filter(Temperature.recorded_at < last)
+			existing = existing.filter(model.recorded_at < last)
+		existing.delete(synchronize_session=False)
+		db.execute(model.__table__.insert().from_select(
+			['sensor_id', 'recorded_at', 'temperature', 'min_temperature', 'max_temperature', 'count'],
+			source.group_by(Temperature.sensor_id, period).statement))
+
+
+def rollup_missing(db: Session, now: Optional[datetime] = None):
+	"""Rolls up what a previous process left behind: the bucket it still had open when it stopped.
+
+	Rollups otherwise only run when the next bucket opens in the same process.
+	Everything from the last rolled up hour, or from the first raw reading
+	still in the table if that is later, up to the current bucket is
+	recomputed. The caller commits.
+	"""
+	first = db.query(func.min(Temperature.recorded_at)).scalar()
+	if first is None:
+		return
+	last = db.query(func.max(TemperatureHourly.recorded_at)).scalar()
+	end = bucket_of(now or datetime.utcnow())
+	start = max(first, last) if last is not None else first
+	if start < end:
+		rollup(db, start, end)
+
+
+if __name__ == '__main__':
+	from app.database import get_db
+	from app.models import create_tables
+
+	create_tables()
+	db = get_db()
+	rollup(db)
+	db.commit()
@@ -1,123 +1,169 @@
 import asyncio
 import os
 import uuid
-from typing import List, Union, Dict, Any, Tuple
+from functools import partial
+from typing import List, Optional
 
-import pandas as pd
-import numpy as np
-from pandas.io.formats.style import Styler
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy import desc
-from sqlalchemy import func
 from fastapi.responses import FileResponse
-from xlsxwriter.worksheet import Worksheet
-
-from app.database import get_db, Session
-from app.helpers import get_temps
-from app.models import Download, House, Sensor
+from starlette.concurrency import run_in_threadpool
+
+from app.database import SessionLocal, get_session, Session
+from app.export_cache import export_cache
+from app.exporter import FORMATS, build_export, pa
+from app.helpers import parse_window
+from app.jobs import export_jobs
+from app.models import Download
 from app.validators.Download import InputValidator, ResponseValidator
-from app.settings import BASE_DIR, DOWNLOADS_DIR
+from app.settings import BASE_DIR, DOWNLOADS_DIR, log
 
 router = APIRouter()
 
-colors = ['#a4caff', '#ffebb8', '#f09cff', '#c5fffa', '#9bffb5', '#ecffb2', '#ffa8d5', '#cabeff']
-
-
-def highlight_cell(temp: dict) -> str:
-	if temp is np.nan or type(temp) is not float:
-		return ''
-
-	if temp['high_threshold']:
-		if temp['temperature'] > temp['high_threshold']:
-			return 'color: blue'
-	if temp['low_threshold']:
-		if temp['temperature'] < temp['low_threshold']:
-			return 'color: red'
-	return ''
-
-
-def obj_to_value(temp: dict) -> Union[float, None]:
-	if temp is np.nan or type(temp) is not float:
-		return temp
-	return temp['temperature']
-
-
-async def save_to_excel(items: List[dict], house_counts: Dict[int, dict], path: str):
-	result = pd.ExcelWriter(path)
-	df = pd.DataFrame(items).set_index('recorded_at')
-	df = df.reindex(df.index.rename('Дата'))
-	df = pd.concat([pd.DataFrame([df.columns], index=[1], columns=df.columns), df])
-	df = pd.concat([pd.DataFrame([[]], index=[0]), df])
-	styling = df.applymap(highlight_cell).copy()
-	df = df.applymap(obj_to_value)
-	styled: Styler = df.style.apply(lambda x: styling, axis=None)
-	styled.to_excel(result, sheet_name='Sheet1')
-	sheet: Worksheet = result.sheets['Sheet1']
-	first_col = 0
-	for index, (house_id, meta_data) in enumerate(house_counts.items()):
-		if not meta_data['count']:
-			continue
-		color = colors[index % len(colors)]
-		merge_format = result.book.add_format({
-			'align': 'center',
-			'valign': 'vcenter',
-			'fg_color': color
-		})
-		house_format = result.book.add_format({'fg_color': color})
-		label = meta_data['house'].label if meta_data['house'] else ''
-		last_col = meta_data['count'] + first_col - 1
-		sheet.merge_range(first_row=1, first_col=first_col,
-						  last_row=1, last_col=last_col,
-						  data=label, cell_format=merge_format)
-		sheet.set_column(first_col=first_col, last_col=last_col, cell_format=house_format)
-		first_col += meta_data['count']
-	sheet.set_column(0, 0, 30)
-	result.save()
-
 
 @router.get('/exports', response_model=List[ResponseValidator])
-async def get_export(db: Session = Depends(get_db)):
+def get_export(db: Session = Depends(get_session)):
 	return db.query(Download).order_by(desc(Download.created_at)).all()
 
 
-@router.post('/exports', response_model=ResponseValidator)
-async def create_export(data: InputValidator, db: Session = Depends(get_db)):
-	data.dict(exclude_unset=True)
-	items = get_temps(db, sensor_ids=data.sensor_ids,
-					  start_date=data.start_date,
-					  end_date=data.end_date,
-					  limit=None,
-					  skip=None, export=True)
-	if not os.path.exists(os.path.join(BASE_DIR, DOWNLOADS_DIR)):
-		os.mkdir(os.path.join(BASE_DIR, DOWNLOADS_DIR))
-	file_name = os.path.join(DOWNLOADS_DIR, uuid.uuid4().hex + '.xlsx')
-	full_path = os.path.join(BASE_DIR, file_name)
-	raw_counts: List[Tuple[Sensor, int]] = db.query(Sensor, func.count(Sensor.house_id)).filter(Sensor.disabled != True).order_by(desc(Sensor.house_id)).group_by(Sensor.house_id).all()
-	house_counts: Dict[int, Dict[str, Any]] = {}
-	print(full_path)
-	for sensor, count in raw_counts:
-		house = db.query(House).get(sensor.house_id) if sensor.house_id else None
-		house_counts[sensor.house_id] = {'count': count, 'house': house}
-	asyncio.create_task(save_to_excel(items, house_counts, full_path))
-	instance = Download(label=data.label, filename=file_name)
+@router.get('/exports/stats')
+def export_stats():
+	return dict(export_jobs.stats(), cache=export_cache.stats())
+
+
+@router.get('/exports/{pk}', response_model=ResponseValidator)
+def get_export_status(pk: int, db: Session = Depends(get_session)):
+	instance: Download = db.query(Download).get(pk)
+	if instance is None:
+		raise HTTPException(status_code=404, detail='Экспорт не найден')
+	return instance
+
+
+def save_download(db: Session, instance: Download) -> Download:
 	db.add(instance)
 	db.commit()
 	return instance
 
 
+def mark_failed(pk: int, error: str):
+	"""Fails a job whose worker died before it could record the failure itself."""
+	db = SessionLocal()
+	try:
+		db.query(Download).filter(Download.id == pk, Download.status.in_(['queued', 'running'])) \
+			.update({'status': 'failed', 'error': error}, synchronize_session=False)
+		db.commit()
+	finally:
+		db.close()
+
+
+def fail_interrupted():
+	"""Jobs still queued or running at startup belonged to a previous server process."""
+	db = SessionLocal()
+	try:
+		db.query(Download).filter(Download.status.in_(['queued', 'running'])) \
+			.update({'status': 'failed', 'error': 'Экспорт прерван перезапуском сервера'}, synchronize_session=False)
+		db.commit()
+	finally:
+		db.close()
+
+
+def evict_exports():
+	"""Keeps the downloads directory within its quota and drops the exports whose file was removed."""
+	db = SessionLocal()
+	try:
+		unfinished = [filename for filename, in db.query(Download.filename)
+					  .filter(Download.status.in_(['queued', 'running']))]
+		removed = export_cache.evict(keep=unfinished)
+		if removed:
+			db.query(Download).filter(Download.filename.in_(removed)).delete(synchronize_session=False)
+			db.commit()
+			log(f'EXPORTS EVICTED::{len(removed)} files', verbose=1)
+	finally:
+		db.close()
+
+
+def export_finished(pk: int, future: asyncio.Future):
+	loop = asyncio.get_event_loop()
+	if future.cancelled():
+		error = 'Экспорт отменён'
+	elif future.exception() is not None:
+		error = str(future.exception()) or type(future.exception()).__name__
+	else:
+		loop.run_in_executor(None, evict_exports)
+		return
+	loop.run_in_executor(None, mark_failed, pk, error)
+
+
+def cached_download(db: Session, data: InputValidator, filename: str) -> Download:
+	"""A finished export of `filename`, an existing file, under the label of this request."""
+	previous: Optional[Download] = db.query(Download) \
+		.filter(Download.filename == filename, Download.status == 'done') \
+		.order_by(desc(Download.created_at)).first()
+	return save_download(db, Download(label=data.label, filename=filename, status='done', progress=1.0,
+									  row_count=previous.row_count if previous else None, duration=0.0))
+
+
+@router.post('/exports', response_model=ResponseValidator)
+async def create_export(data: InputValidator, db: Session = Depends(get_session)):
+	if data.format == 'parquet' and pa is None:
+		raise HTTPException(status_code=400, detail='Экспорт в parquet недоступен: не установлен pyarrow')
+	# The slot is taken before the first await, so concurrent requests cannot all get past the limit.
+	if not export_jobs.reserve():
+		raise HTTPException(status_code=429, detail='Слишком много экспортов в очереди, попробуйте позже')
+	instance: Optional[Download] = None
+	submitted = False
+	try:
+		if not os.path.exists(os.path.join(BASE_DIR, DOWNLOADS_DIR)):
+			os.mkdir(os.path.join(BASE_DIR, DOWNLOADS_DIR))
+		extension = FORMATS[data.format or 'xlsx'][0]
+		key = await run_in_threadpool(export_cache.key, db, data.sensor_ids, parse_window(data.start_date, data.end_date),
+									  data.resolution, extension)
+		if key is not None:
+			file_name = export_cache.filename(key, extension)
+			if export_cache.lookup(file_name):
+				return await run_in_threadpool(cached_download, db, data, file_name)
+		else:
+			file_name = os.path.join(DOWNLOADS_DIR, uuid.uuid4().hex + extension)
+		full_path = os.path.join(BASE_DIR, file_name)
+		print(full_path)
+		instance = await run_in_threadpool(save_download, db, Download(label=data.label, filename=file_name,
+																		status='queued', progress=0.0))
+		future = export_jobs.submit(build_export, instance.id, data.dict(), full_path)
+		submitted = True
+	except Exception as e:
+		if instance is not None:
+			await run_in_threadpool(mark_failed, instance.id, str(e) or type(e).__name__)
+		raise
+	finally:
+		if not submitted:
+			export_jobs.release()
+	future.add_done_callback(partial(export_finished, instance.id))
+	return instance
+
+
 @router.delete('/exports/{pk}', response_model=ResponseValidator)
-async def delete_export(pk: int, db: Session = Depends(get_db)):
+def delete_export(pk: int, db: Session = Depends(get_session)):
 	instance: Download = db.query(Download).get(pk)
 	db.delete(instance)
 	db.commit()
-	os.remove(os.path.join(BASE_DIR, instance.filename))
+	shared = db.query(Download.id).filter(Download.filename == instance.filename).first()
+	path = os.path.join(BASE_DIR, instance.filename)
+	if shared is None and os.path.exists(path):
+		os.remove(path)
 	return instance
 
 
 @router.get('/download/{pk}/')
-async def download_excel(pk: int, db: Session = Depends(get_db)):
+def download_excel(pk: int, db: Session = Depends(get_session)):
 	download: Download = db.query(Download).get(pk)
-	filename = download.label + '.xlsx'
-	return FileResponse(os.path.join(BASE_DIR, download.filename),
-						media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-						filename=filename)
+	if download is None:
+		raise HTTPException(status_code=404, detail='Экспорт не найден')
+	if download.status != 'done':
+		raise HTTPException(status_code=409, detail='Экспорт ещё не готов')
+	if not os.path.exists(os.path.join(BASE_DIR, download.filename)):
+		raise HTTPException(status_code=404, detail='Файл экспорта удалён')
+	export_cache.touch(download.filename)
+	extension, media_type, _ = next((value for value in FORMATS.values() if download.filename.endswith(value[0])),
+									FORMATS['xlsx'])
+	return FileResponse(os.path.join(BASE_DIR, download.filename), media_type=media_type,
+						filename=download.label + extension)
@@ -1,6 +1,7 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request, Response
 
-from app.database import get_db, Session
+from app.database import get_session, Session
+from app.etags import check_etag
 from app.models import House
 from app.validators.Houses import InputValidator, ResponseValidator
 
@@ -8,19 +9,22 @@ router = APIRouter()
 
 
 @router.get('/houses')
-async def find_houses(db: Session = Depends(get_db)):
+def find_houses(request: Request, response: Response, db: Session = Depends(get_session)):
+	cached = check_etag(request, response, House.__tablename__)
+	if cached is not None:
+		return cached
 	items = db.query(House).all()
 	return items
 
 
 @router.get('/houses/{pk}')
-async def get_house(pk: int, db: Session = Depends(get_db)):
+def get_house(pk: int, db: Session = Depends(get_session)):
 	item = db.query(House).get(pk)
 	return item
 
 
 @router.post('/houses', response_model=ResponseValidator)
-async def create_house(data: InputValidator, db: Session = Depends(get_db)):
+def create_house(data: InputValidator, db: Session = Depends(get_session)):
 	instance = House(**data.dict(exclude_unset=True))
 	db.add(instance)
 	db.commit()
@@ -28,7 +32,7 @@ async def create_house(data: InputValidator, db: Session = Depends(get_db)):
 
 
 @router.patch('/houses/{pk}', response_model=ResponseValidator)
-async def patch_house(pk: int, data: InputValidator, db: Session = Depends(get_db)):
+def patch_house(pk: int, data: InputValidator, db: Session = Depends(get_session)):
 	instance = db.query(House).get(pk)
 	for key, value in data.dict(exclude_unset=True).items():
 		setattr(instance, key, value)
@@ -37,7 +41,7 @@ async def patch_house(pk: int, data: InputValidator, db: Session = Depends(get_d
 
 
 @router.delete('/houses/{pk}', response_model=ResponseValidator)
-async def delete_house(pk: int, db: Session = Depends(get_db)):
+def delete_house(pk: int, db: Session = Depends(get_session)):
 	instance = db.query(House).get(pk)
 	db.delete(instance)
 	db.commit()
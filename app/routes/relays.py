@@ -1,6 +1,8 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request, Response
 
-from app.database import get_db, Session
+from app.database import get_session, Session
+from app.etags import check_etag
+from app.gpio import Relay
 from app.models import Relays
 from app.validators.Relay import InputValidator, ResponseValidator
 
@@ -8,19 +10,33 @@ router = APIRouter()
 
 
 @router.get('/relays')
-async def find_relays(db: Session = Depends(get_db)):
+def find_relays(request: Request, response: Response, db: Session = Depends(get_session)):
+	cached = check_etag(request, response, Relays.__tablename__)
+	if cached is not None:
+		return cached
 	items = db.query(Relays).all()
 	return items
 
 
+@router.get('/relays/state')
+def relays_state(db: Session = Depends(get_session)):
+	relays = {item.pin: item for item in db.query(Relays).all()}
+	result = Relay.snapshot()
+	for item in result:
+		relay = relays.get(item['pin'])
+		item['id'] = relay.id if relay else None
+		item['label'] = relay.label if relay else None
+	return result
+
+
 @router.get('/relays/{pk}')
-async def get_relay(pk: int, db: Session = Depends(get_db)):
+def get_relay(pk: int, db: Session = Depends(get_session)):
 	item = db.query(Relays).get(pk)
 	return item
 
 
 @router.post('/relays', response_model=ResponseValidator)
-async def create_relay(data: InputValidator, db: Session = Depends(get_db)):
+def create_relay(data: InputValidator, db: Session = Depends(get_session)):
 	instance = Relays(**data.dict(exclude_unset=True))
 	db.add(instance)
 	db.commit()
@@ -28,7 +44,7 @@ async def create_relay(data: InputValidator, db: Session = Depends(get_db)):
 
 
 @router.patch('/relays/{pk}', response_model=ResponseValidator)
-async def patch_relay(pk: int, data: InputValidator, db: Session = Depends(get_db)):
+def patch_relay(pk: int, data: InputValidator, db: Session = Depends(get_session)):
 	instance = db.query(Relays).get(pk)
 	for key, value in data.dict(exclude_unset=True).items():
 		setattr(instance, key, value)
@@ -37,7 +53,7 @@ async def patch_relay(pk: int, data: InputValidator, db: Session = Depends(get_d
 
 
 @router.delete('/relays/{pk}', response_model=ResponseValidator)
-async def delete_relay(pk: int, db: Session = Depends(get_db)):
+def delete_relay(pk: int, db: Session = Depends(get_session)):
 	instance = db.query(Relays).get(pk)
 	db.delete(instance)
 	db.commit()
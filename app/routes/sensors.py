@@ -1,16 +1,17 @@
-import asyncio
-from typing import Union, List
+from typing import Dict, Union, List
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request, Response
+from sqlalchemy import func
 
-from app.database import get_db, Session
+from app.database import get_session, Session
+from app.etags import check_etag
 from app.models import Sensor
 from app.validators.Sensor import InputValidator, PatchValidator, ResponseValidator
 
 router = APIRouter()
 
 
-async def patch_pair_sensor(db: Session, instance: Sensor):
+def patch_pair_sensor(db: Session, instance: Sensor):
 	pair_sensors: Union[List[Sensor], None] = db.query(Sensor).filter(Sensor.pair == instance.id).all()
 	if not pair_sensors:
 		return
@@ -19,43 +20,52 @@ async def patch_pair_sensor(db: Session, instance: Sensor):
 	db.commit()
 
 
+def pair_counts(db: Session) -> Dict[int, int]:
+	"""Number of sensors paired to each sensor, in one query."""
+	return dict(db.query(Sensor.pair, func.count(Sensor.id)).filter(Sensor.pair.isnot(None)).group_by(Sensor.pair))
+
+
 @router.get('/sensors')
-async def find_sensors(db: Session = Depends(get_db)):
+def find_sensors(request: Request, response: Response, db: Session = Depends(get_session)):
+	cached = check_etag(request, response, Sensor.__tablename__)
+	if cached is not None:
+		return cached
 	items = db.query(Sensor).all()
+	counts = pair_counts(db)
 	for item in items:
-		item.count = db.query(Sensor).filter(Sensor.pair == item.id).count()
+		item.count = counts.get(item.id, 0)
 	return items
 
 
 @router.get('/sensors/{pk}')
-async def get_sensor(pk: int, db: Session = Depends(get_db)):
+def get_sensor(pk: int, db: Session = Depends(get_session)):
 	item = db.query(Sensor).get(pk)
-	item.count = db.query(Sensor).filter(Sensor.pair == item.id).count()
+	item.count = db.query(func.count(Sensor.id)).filter(Sensor.pair == item.id).scalar()
 	return item
 
 
 @router.post('/sensors', response_model=ResponseValidator)
-async def create_sensor(data: InputValidator, db: Session = Depends(get_db)):
+def create_sensor(data: InputValidator, db: Session = Depends(get_session)):
 	instance = Sensor(**data.dict(exclude_unset=True))
 	db.add(instance)
 	db.commit()
-	asyncio.create_task(patch_pair_sensor(db, instance))
+	patch_pair_sensor(db, instance)
 	return instance
 
 
 @router.patch('/sensors/{pk}', response_model=ResponseValidator)
-async def patch_sensor(pk: int, data: PatchValidator, db: Session = Depends(get_db)):
+def patch_sensor(pk: int, data: PatchValidator, db: Session = Depends(get_session)):
 	instance = db.query(Sensor).get(pk)
 	for key, value in data.dict(exclude_unset=True).items():
 		setattr(instance, key, value)
 	db.commit()
 	print(data.dict(exclude_unset=True))
-	asyncio.create_task(patch_pair_sensor(db, instance))
+	patch_pair_sensor(db, instance)
 	return instance
 
 
 @router.delete('/sensors/{pk}', response_model=ResponseValidator)
-async def delete_sensor(pk: int, db: Session = Depends(get_db)):
+def delete_sensor(pk: int, db: Session = Depends(get_session)):
 	instance = db.query(Sensor).get(pk)
 	db.delete(instance)
 	db.commit()
@@ -1,9 +1,11 @@
-from typing import List
+from typing import List, Optional, Set
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from app.validators.Temperature import ResponseValidator
-from app.helpers import get_temps
+from app.helpers import get_temps, stream_temps
+from app.processing import readers
 
 router = APIRouter()
 
@@ -11,9 +13,33 @@ router = APIRouter()
 class PaginatedResponse(BaseModel):
 	total: int
 	data: List[ResponseValidator]
+	next: Optional[str]
+	prev: Optional[str]
 
 
 # noinspection PyTypeChecker
 @router.get('/temperatures')
 async def find_temperatures(result=Depends(get_temps)):
 	return result
+
+
+@router.get('/temperatures/stream')
+def stream_temperatures(sensor_ids: Optional[Set[int]] = Query(None),
+						start_date: Optional[str] = Query(None),
+						end_date: Optional[str] = Query(None),
+						resolution: Optional[str] = Query(None),
+						format: str = Query('ndjson', regex='^(ndjson|csv)$')):
+	media_type = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+	return StreamingResponse(stream_temps(sensor_ids, start_date, end_date, resolution, format), media_type=media_type)
+
+
+@router.get('/temperatures/live')
+async def live_temperatures(sensor_ids: Optional[Set[int]] = Query(None),
+							seconds: Optional[float] = Query(600, gt=0),
+							step: Optional[float] = Query(None, gt=0)):
+	return readers.live.window(sensor_ids, seconds, step=step)
+
+
+@router.get('/temperatures/live/stats')
+async def live_stats():
+	return readers.live.stats()
@@ -1,10 +1,21 @@
 import asyncio
+import json
+import math
 import random
-from typing import Tuple, List
+import time
+from types import SimpleNamespace
+from typing import Tuple, List, Optional, Callable, Dict
+
+from sqlalchemy.orm import Session
 
 from app.database import get_db
 from app.models import Sensor
-from app.settings import RTD_A, RTD_B
+from app.serial_ports import parse_line
+from app.settings import (RTD_A, RTD_B, RETRY_IN, SIMULATED_PORTS, SIMULATED_SENSORS, SIMULATED_SEED, SIMULATED_RATE,
+						  SIMULATED_PROFILE, SIMULATED_GARBLE, SIMULATED_DROP, SIMULATED_DISCONNECT, log)
+from app.writer import writer
+
+SENSORS_REFRESH = 10
 
 
 def rtd_from_temp(sensor: Sensor, temp: float) -> int:
@@ -22,17 +33,137 @@ def rtd_from_temp(sensor: Sensor, temp: float) -> int:
 	return rtd
 
 
+def noise(elapsed: float, idx: int) -> float:
+	return 22 + random.random() * 3
+
+
+def ramp(elapsed: float, idx: int) -> float:
+	return 15 + (elapsed * 0.1 + idx) % 20
+
+
+def spike(elapsed: float, idx: int) -> float:
+	return noise(elapsed, idx) + (15 if random.random() < 0.01 else 0)
+
+
+def step(elapsed: float, idx: int) -> float:
+	return 20 + 8 * (int(elapsed / 60 + idx) % 2)
+
+
+def sine(elapsed: float, idx: int) -> float:
+	return 23 + 5 * math.sin(elapsed / 600 + idx)
+
+
+PROFILES: Dict[str, Callable[[float, int], float]] = {'noise': noise, 'ramp': ramp, 'spike': spike, 'step': step, 'sine': sine}
+
+
+def discover_ports() -> List[str]:
+	return [f'SIM{idx}' for idx in range(SIMULATED_PORTS)]
+
+
 class SerialPortWrapper:
+	"""Stands in for an Arduino and doubles as a load generator.
+
+	Emits frames for the sensors assigned to its port, or for `sensors`
+	synthetic 1000 Ω sensors on pins 1..N, at `rate` frames per second. Frames
+	can be garbled, dropped, or the port disconnected, with the given
+	per-frame probabilities. With `seed` the synthetic sensors missing from
+	the database are added on connect, on this port, so the readers convert
+	and store their readings.
+	"""
 	failed_reads: int = 0
-	connected: bool = True
+	connected: bool = False
+
+	def __init__(self, port: Optional[str] = None, sensors: int = SIMULATED_SENSORS, rate: float = SIMULATED_RATE,
+				 profile: str = SIMULATED_PROFILE, garble: float = SIMULATED_GARBLE, drop: float = SIMULATED_DROP,
+				 disconnect: float = SIMULATED_DISCONNECT, seed: bool = SIMULATED_SEED):
+		ports = discover_ports()
+		self.port = port or ports[0]
+		self.default = self.port == ports[0]
+		self.synthetic = sensors
+		self.period = 1 / rate
+		self.profile = PROFILES[profile]
+		self.garble = garble
+		self.drop = drop
+		self.disconnect = disconnect
+		self.seed = seed and bool(sensors)
+		self.sensors: list = []
+		self.loaded_at: float = 0
+		self.started_at = time.monotonic()
+		self.next_frame = self.started_at
+		self.frames: int = 0
+		self.garbled: int = 0
+		self.dropped: int = 0
+		self.disconnects: int = 0
+
+	def _owns(self, sensor: Sensor) -> bool:
+		return sensor.port == self.port or (sensor.port is None and self.default)
+
+	def _load_sensors(self):
+		if self.synthetic:
+			if not self.sensors:
+				self.sensors = [SimpleNamespace(pin=pin, sensor_type=1000, wire_resistance=0, correction_resistance=0)
+								for pin in range(1, self.synthetic + 1)]
+			return
+		if time.monotonic() - self.loaded_at < SENSORS_REFRESH:
+			return
+		self.sensors = [SimpleNamespace(pin=sensor.pin, sensor_type=sensor.sensor_type, wire_resistance=sensor.wire_resistance,
+										correction_resistance=sensor.correction_resistance)
+						for sensor in get_db().query(Sensor).all() if self._owns(sensor)]
+		self.loaded_at = time.monotonic()
+
+	def _line(self) -> bytes:
+		elapsed = time.monotonic() - self.started_at
+		data = [{'pin': sensor.pin, 'rtd': rtd_from_temp(sensor, round(self.profile(elapsed, idx), 1))}
+				for idx, sensor in enumerate(self.sensors)]
+		line = json.dumps(data).encode()
+		if self.garble and random.random() < self.garble:
+			self.garbled += 1
+			cut = random.randrange(len(line))
+			line = line[:cut] + b'\xff' + line[cut + 1:]
+		return line
 
 	async def read(self) -> Tuple[List[dict], str]:
-		data = []
-		await asyncio.sleep(1)
-		for sensor in get_db().query(Sensor).all():
-			temperature = round((22 + random.random() * 3), 1)
-			data.append({'pin': sensor.pin, 'rtd': rtd_from_temp(sensor, temperature)})
+		self.next_frame = max(self.next_frame + self.period, time.monotonic())
+		await asyncio.sleep(self.next_frame - time.monotonic())
+		if self.disconnect and random.random() < self.disconnect:
+			self.disconnects += 1
+			self.connected = False
+			asyncio.get_event_loop().call_later(RETRY_IN, lambda: asyncio.ensure_future(self.connect_to_serial()))
+			return [], 'Не удалось считать данные с сенсора'
+		if self.drop and random.random() < self.drop:
+			self.dropped += 1
+			return [], ''
+		self._load_sensors()
+		try:
+			data = parse_line(memoryview(self._line()))
+		except ValueError:
+			return [], 'Датчик отправляет искаженные данные'
+		self.frames += 1
 		return data, ''
 
+	def _seed(self, db: Session) -> int:
+		existing = {pin for pin, in db.query(Sensor.pin).filter(Sensor.port == self.port)}
+		missing = [pin for pin in range(1, self.synthetic + 1) if pin not in existing]
+		# A 'street' sensor is exported under its label alone.
+		db.add_all([Sensor(label=f'{self.port}-{pin}', pin=pin, port=self.port, sensor_type=1000, location='street',
+						   disabled=False, wire_resistance=0, correction_resistance=0) for pin in missing])
+		return len(missing)
+
 	async def connect_to_serial(self):
-		return
+		if self.seed:
+			log(f'SIMULATED SENSORS ADDED::{self.port} {await writer.submit(self._seed)}')
+			self.seed = False
+		self.connected = True
+		self.next_frame = time.monotonic()
+
+	def close(self):
+		self.connected = False
+
+	def stats(self) -> List[dict]:
+		return [{
+			'port': self.port,
+			'frames': self.frames,
+			'garbled': self.garbled,
+			'dropped': self.dropped,
+			'disconnects': self.disconnects,
+		}]
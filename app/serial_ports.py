@@ -1,16 +1,20 @@
 import time
-import time
 import re
 import asyncio
 import json
-from typing import List, Tuple
+import threading
+from typing import Any, Callable, Dict, List, Tuple, Optional
 
-import aioserial
 import serial
-from aioserial import AioSerial
 from serial.tools import list_ports
 
-from app.settings import RETRY_IN, BAUD_RATE, MAX_FAILED_ATTEMPTS, log
+from app.settings import (RETRY_IN, BAUD_RATE, MAX_FAILED_ATTEMPTS, MAX_RETRY_IN, SERIAL_QUEUE_SIZE, SERIAL_CHUNK_SIZE,
+						  SERIAL_MAX_PENDING_CHUNKS, SERIAL_MERGE_WINDOW, log)
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
 
 
 def time_it(func):
@@ -24,54 +28,310 @@ def time_it(func):
 	return wrapper
 
 
+def parse_line(line: memoryview):
+	if orjson is not None:
+		return orjson.loads(line)
+	return json.loads(bytes(line))
+
+
+class SerialIngestor(threading.Thread):
+	"""Reads a serial port on its own thread and hands parsed frames to asyncio.
+
+	Whatever the port has buffered is read into one reusable chunk and appended
+	to a pending buffer that is split on newlines in place. Parsed frames go to
+	a bounded queue; when the event loop falls behind the oldest frame is
+	dropped. Bytes that run past `max_pending_chunks` chunks without a newline
+	are discarded.
+	"""
+
+	def __init__(self, port: serial.Serial, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue,
+				 chunk_size: int = SERIAL_CHUNK_SIZE, max_pending_chunks: int = SERIAL_MAX_PENDING_CHUNKS):
+		super().__init__(name=f'serial-{port.port}', daemon=True)
+		self.port = port
+		self.loop = loop
+		self.queue = queue
+		self.chunk = bytearray(chunk_size)
+		self.pending = bytearray()
+		self.max_pending = chunk_size * max_pending_chunks
+		self.running = True
+		self.error: Optional[Exception] = None
+		self.bytes: int = 0
+		self.frames: int = 0
+		self.parse_errors: int = 0
+		self.drops: int = 0
+		self.overflows: int = 0
+
+	def _deliver(self, frame: list):
+		if self.queue.full():
+			self.queue.get_nowait()
+			self.drops += 1
+		self.queue.put_nowait(frame)
+
+	def _split(self):
+		start = 0
+		with memoryview(self.pending) as view:
+			while True:
+				end = self.pending.find(b'\n', start)
+				if end == -1:
+					break
+				with view[start:end] as line:
+					frame = self._parse(line)
+				start = end + 1
+				if frame is not None:
+					self.frames += 1
+					self.loop.call_soon_threadsafe(self._deliver, frame)
+		del self.pending[:start]
+
+	def _parse(self, line: memoryview) -> Optional[list]:
+		if not len(line) or line == b'\r':
+			return None
+		try:
+			frame = parse_line(line)
+		except ValueError:
+			self.parse_errors += 1
+			return None
+		if type(frame) is not list:
+			self.parse_errors += 1
+			return None
+		return frame
+
+	def run(self):
+		while self.running:
+			try:
+				# Only what has arrived, or one byte, so a frame is never held back until a chunk fills up.
+				size = min(max(1, self.port.in_waiting), len(self.chunk))
+				with memoryview(self.chunk)[:size] as chunk:
+					count = self.port.readinto(chunk)
+			except (serial.SerialException, OSError) as e:
+				self.error = e
+				break
+			if not count:
+				continue
+			self.bytes += count
+			with memoryview(self.chunk) as chunk:
+				self.pending += chunk[:count]
+			self._split()
+			if len(self.pending) > self.max_pending:
+				self.pending.clear()
+				self.overflows += 1
+		self.running = False
+
+	def stop(self):
+		self.running = False
+
+	def stats(self) -> dict:
+		return {
+			'port': self.port.port,
+			'alive': self.is_alive(),
+			'bytes': self.bytes,
+			'frames': self.frames,
+			'parse_errors': self.parse_errors,
+			'queue_drops': self.drops,
+			'overflows': self.overflows,
+			'queued': self.queue.qsize(),
+		}
+
+
+def discover_ports() -> List[str]:
+	return [item.device for item in list_ports.comports() if re.match(r'COM\d+', item.device) or re.match(r'/dev/ttyACM\d+', item.device)]
+
+
 class SerialPortWrapper:
-	serial_port: AioSerial
+	serial_port: serial.Serial
+	ingestor: Optional[SerialIngestor] = None
+	queue: asyncio.Queue
 	failed_reads: int = 0
 	connected: bool = False
+	closed: bool = False
+
+	def __init__(self, port: Optional[str] = None):
+		self.port = port
+		self.retry_in = RETRY_IN
+
+	def _retry_later(self):
+		self.connected = False
+		if self.closed:
+			return
+		asyncio.get_event_loop().call_later(self.retry_in, lambda: asyncio.ensure_future(self.connect_to_serial()))
+		self.retry_in = min(self.retry_in * 2, MAX_RETRY_IN)
 
 	async def connect_to_serial(self):
-		ports = list_ports.comports()
-		port = next((item.device for item in ports if re.match(r'COM\d+', item.device) or re.match(r'/dev/ttyACM\d+', item.device)), None)
+		if self.closed:
+			return
+		port = self.port or next(iter(discover_ports()), None)
 		if port is None:
-			print(f"Could not find any serial device. Retrying in {RETRY_IN} seconds...")
-			self.connected = False
-			await asyncio.sleep(RETRY_IN)
-			asyncio.create_task(self.connect_to_serial())
+			print(f"Could not find any serial device. Retrying in {self.retry_in} seconds...")
+			self._retry_later()
 			return
 		log(port)
 
 		try:
-			self.serial_port: AioSerial = AioSerial(port=port, baudrate=BAUD_RATE, bytesize=8, timeout=2, stopbits=aioserial.STOPBITS_ONE)
+			self.serial_port = serial.Serial(port=port, baudrate=BAUD_RATE, bytesize=8, timeout=2, stopbits=serial.STOPBITS_ONE)
 			log('SERIAL_PORT STATE::', self.serial_port.isOpen())
-			self.connected = True
 		except serial.SerialException as e:
-			self.connected = False
-			print(e, f"Retrying in {RETRY_IN} seconds...")
-			await asyncio.sleep(RETRY_IN)
-			asyncio.create_task(self.connect_to_serial())
+			print(e, f"Retrying in {self.retry_in} seconds...")
+			self._retry_later()
 			return
+		self.queue = asyncio.Queue(maxsize=SERIAL_QUEUE_SIZE)
+		self.ingestor = SerialIngestor(self.serial_port, asyncio.get_event_loop(), self.queue)
+		self.ingestor.start()
+		self.retry_in = RETRY_IN
+		self.connected = True
+
+	def _disconnect(self):
+		self.connected = False
+		if self.ingestor is not None:
+			self.ingestor.stop()
+		try:
+			self.serial_port.close()
+		except (AttributeError, serial.SerialException):
+			pass
+
+	async def _reconnect(self):
+		self._disconnect()
+		if not self.closed:
+			await self.connect_to_serial()
+
+	def close(self):
+		"""Stops reading for good, once the device is gone."""
+		self.closed = True
+		self._disconnect()
 
 	async def read(self) -> Tuple[List[dict], str]:
+		parse_errors = self.ingestor.parse_errors + self.ingestor.overflows
 		try:
-			log('SERIAL PORT STATE::', self.serial_port.isOpen())
-			message: str = (await self.serial_port.readline_async()).decode('Ascii')
-		except (serial.SerialException, UnicodeDecodeError) as e:
-			print(e, f"Failed to read of port {self.serial_port.port}. Failed reads {self.failed_reads}. Retrying in {RETRY_IN} seconds...")
+			result = await asyncio.wait_for(self.queue.get(), timeout=2)
+		except asyncio.TimeoutError:
+			if self.ingestor.is_alive():
+				if self.ingestor.parse_errors + self.ingestor.overflows != parse_errors:
+					return [], 'Датчик отправляет искаженные данные'
+				return [], 'Не удалось считать данные с сенсора'
+			print(self.ingestor.error, f"Failed to read of port {self.serial_port.port}. Failed reads {self.failed_reads}. Retrying in {RETRY_IN} seconds...")
 			self.failed_reads += 1
 			await asyncio.sleep(RETRY_IN)
 			if self.failed_reads > MAX_FAILED_ATTEMPTS:
 				print(f'Reached maximum number({MAX_FAILED_ATTEMPTS}) of failed attempts. Retrying to connect.')
-				# self.serial_port.close()
-				asyncio.create_task(self.connect_to_serial())
+				asyncio.create_task(self._reconnect())
 				self.failed_reads = 0
 				return [], 'Попытка переподключиться к датчикам'
 			return [], 'Не удалось считать данные с сенсора'
-		try:
-			log('message', message, verbose=2)
-			result = json.loads(message)
-			if type(result) is not list:
-				return [], 'Датчик отправляет искаженные данные'
-		except json.decoder.JSONDecodeError:
-			return [], 'Датчик отправляет искаженные данные'
 		self.failed_reads = 0
 		return result, ''
+
+	def stats(self) -> List[dict]:
+		return [self.ingestor.stats()] if self.ingestor is not None else []
+
+
+class SerialPorts:
+	"""Reads every attached controller at once and merges their frames.
+
+	Each controller is a `SerialPortWrapper` (or a simulator) with its own
+	reconnect and backoff state, read by its own task. `read` returns one
+	frame of every connected controller, waiting up to `merge_window` seconds
+	after the first for the others, with each reading tagged by the port it
+	came from. A controller whose device is no longer discovered is closed
+	and dropped. `on_release` is called with the port of a controller that
+	disconnects or is dropped.
+	"""
+
+	def __init__(self, factory: Callable[[str], Any] = SerialPortWrapper,
+				 discover: Callable[[], List[str]] = discover_ports, merge_window: float = SERIAL_MERGE_WINDOW,
+				 on_release: Optional[Callable[[str], None]] = None):
+		self.factory = factory
+		self.merge_window = merge_window
+		self.discover = discover
+		self.on_release = on_release
+		self.controllers: Dict[str, Any] = {}
+		self.pumps: Dict[str, asyncio.Task] = {}
+		self.errors: Dict[str, str] = {}
+		self.queue: Optional[asyncio.Queue] = None
+
+	@property
+	def connected(self) -> bool:
+		return any(item.connected for item in self.controllers.values())
+
+	async def connect_to_serial(self):
+		self.queue = asyncio.Queue(maxsize=SERIAL_QUEUE_SIZE)
+		await self._discover()
+		asyncio.create_task(self._discover_forever())
+
+	def _release(self, port: str):
+		if self.on_release is not None:
+			self.on_release(port)
+
+	def _drop(self, port: str):
+		self.pumps.pop(port).cancel()
+		self.controllers.pop(port).close()
+		self.errors.pop(port, None)
+		self._release(port)
+		log(f'SERIAL_PORT GONE::{port}')
+
+	async def _discover(self):
+		ports = self.discover()
+		for port in [port for port in self.controllers if port not in ports]:
+			self._drop(port)
+		for port in ports:
+			if port in self.controllers:
+				continue
+			controller = self.factory(port)
+			self.controllers[port] = controller
+			await controller.connect_to_serial()
+			self.pumps[port] = asyncio.create_task(self._pump(port, controller))
+
+	async def _discover_forever(self):
+		while True:
+			await asyncio.sleep(RETRY_IN)
+			await self._discover()
+
+	async def _pump(self, port: str, controller):
+		released = False
+		while True:
+			if not controller.connected:
+				self.errors[port] = 'Не возможно подключиться к датчикам'
+				if not released:
+					self._release(port)
+					released = True
+				await asyncio.sleep(1)
+				continue
+			released = False
+			frame, error = await controller.read()
+			self.errors[port] = error
+			if not frame:
+				continue
+			if self.queue.full():
+				self.queue.get_nowait()
+			self.queue.put_nowait((port, frame))
+
+	async def read(self) -> Tuple[List[dict], str]:
+		try:
+			port, frame = await asyncio.wait_for(self.queue.get(), timeout=2)
+		except asyncio.TimeoutError:
+			return [], next((error for error in self.errors.values() if error), 'Не удалось считать данные с сенсора')
+		frames = {port: frame}
+		expected = {port for port, controller in self.controllers.items() if controller.connected}
+		deadline = asyncio.get_event_loop().time() + self.merge_window
+		while not expected <= frames.keys():
+			remaining = deadline - asyncio.get_event_loop().time()
+			if remaining <= 0:
+				break
+			try:
+				port, frame = await asyncio.wait_for(self.queue.get(), timeout=remaining)
+			except asyncio.TimeoutError:
+				break
+			frames[port] = frame
+		while not self.queue.empty():
+			port, frame = self.queue.get_nowait()
+			frames[port] = frame
+		result = []
+		for port, frame in sorted(frames.items()):
+			# Frames a dropped controller queued before it was dropped.
+			if port not in self.controllers:
+				continue
+			for item in frame:
+				item['port'] = port
+				result.append(item)
+		return result, next((error for error in self.errors.values() if error), '')
+
+	def stats(self) -> List[dict]:
+		return [dict(item, port=port, connected=controller.connected)
+				for port, controller in self.controllers.items() for item in controller.stats() or [{}]]
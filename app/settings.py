@@ -8,6 +8,37 @@ RTD_B = - 5.775e-7
 BAUD_RATE = 250_000
 MAX_FAILED_ATTEMPTS = 4
 RETRY_IN = 10
+BUCKET_MINUTES = 15
+WS_QUEUE_SIZE = 10
+SERIAL_QUEUE_SIZE = 100
+SERIAL_CHUNK_SIZE = 4096
+# A line longer than this many chunks is never a frame, the pending bytes are dropped.
+SERIAL_MAX_PENDING_CHUNKS = 64
+SERIAL_MERGE_WINDOW = 1
+MAX_RETRY_IN = 300
+SIMULATED_PORTS = int(os.environ.get('SIMULATED_PORTS', 1))
+SIMULATED_SENSORS = int(os.environ.get('SIMULATED_SENSORS', 0))
+# Adds database sensors matching the synthetic ones, so their readings go through the whole pipeline.
+SIMULATED_SEED = bool(int(os.environ.get('SIMULATED_SEED', 1)))
+SIMULATED_RATE = float(os.environ.get('SIMULATED_RATE', 1))
+SIMULATED_PROFILE = os.environ.get('SIMULATED_PROFILE', 'noise')
+SIMULATED_GARBLE = float(os.environ.get('SIMULATED_GARBLE', 0))
+SIMULATED_DROP = float(os.environ.get('SIMULATED_DROP', 0))
+SIMULATED_DISCONNECT = float(os.environ.get('SIMULATED_DISCONNECT', 0))
+WRITER_BATCH_SIZE = 50
+DB_THREADS = 4
+LOOP_MONITOR_INTERVAL = 0.1
+LOOP_STALL_THRESHOLD = 0.05
+ARCHIVE_DIR = 'archive'
+RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', 90))
+RETENTION_INTERVAL = 3600
+LIVE_HOURS = float(os.environ.get('LIVE_HOURS', 2))
+LIVE_RATE = float(os.environ.get('LIVE_RATE', 1))
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 1))
+EXPORT_MAX_PENDING = int(os.environ.get('EXPORT_MAX_PENDING', 4))
+EXPORT_WRITER = os.environ.get('EXPORT_WRITER', 'stream')
+EXPORT_CACHE_MB = int(os.environ.get('EXPORT_CACHE_MB', 1024))
+CSV_COMPRESSION = int(os.environ.get('CSV_COMPRESSION', 6))
 
 
 def log(*args, verbose=1):
@@ -1,6 +1,7 @@
 from typing import Optional, List, Set
 from datetime import datetime
 from pydantic import BaseModel
+from typing_extensions import Literal
 
 
 class InputValidator(BaseModel):
@@ -8,6 +9,8 @@ class InputValidator(BaseModel):
 	start_date: Optional[str]
 	end_date: Optional[str]
 	sensor_ids: Optional[Set[int]]
+	resolution: Optional[Literal['raw', 'hour', 'day']]
+	format: Optional[Literal['xlsx', 'csv.gz', 'parquet']]
 
 
 class ResponseValidator(BaseModel):
@@ -15,6 +18,11 @@ class ResponseValidator(BaseModel):
 	label: str
 	filename: str
 	created_at: datetime
+	status: Optional[Literal['queued', 'running', 'done', 'failed']]
+	progress: Optional[float]
+	row_count: Optional[int]
+	duration: Optional[float]
+	error: Optional[str]
 
 	class Config:
 		orm_mode = True
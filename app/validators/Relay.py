@@ -8,6 +8,8 @@ class InputValidator(BaseModel):
 	pin: int
 	disabled: Optional[bool] = False
 	fire_on_threshold: Optional[bool] = False
+	min_on: Optional[float] = 0.0
+	min_off: Optional[float] = 0.0
 
 
 class ResponseValidator(InputValidator):
@@ -6,6 +6,7 @@ from pydantic import BaseModel
 class InputValidator(BaseModel):
 	label: Optional[str]
 	pin: int
+	port: Optional[str]
 	sensor_type: int
 	location: str
 	wire_resistance: Optional[float]
@@ -0,0 +1,96 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal
+from app.settings import WRITER_BATCH_SIZE, log
+
+
+class DatabaseWriter:
+	"""Runs every write of the reader loop and calibration on one session.
+
+	Jobs are callables taking the session. They are queued and committed
+	together, up to `batch_size` per commit, by a single task that runs each
+	batch on a thread of its own, so rollups and commits never block the event
+	loop and the session is only ever used from that thread. If the commit
+	fails the whole batch is rolled back and every job in it gets the exception.
+	"""
+
+	def __init__(self, session: Session, batch_size: int = WRITER_BATCH_SIZE):
+		self.session = session
+		self.batch_size = batch_size
+		self.queue: Optional[asyncio.Queue] = None
+		self.task: Optional[asyncio.Task] = None
+		self.executor: Optional[ThreadPoolExecutor] = None
+		self.jobs: int = 0
+		self.commits: int = 0
+		self.failures: int = 0
+
+	def _ensure_running(self):
+		if self.executor is None:
+			self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='writer')
+		if self.task is None or self.task.done():
+			self.queue = asyncio.Queue()
+			self.task = asyncio.ensure_future(self._run())
+
+	def submit(self, job: Callable[[Session], Any]) -> asyncio.Future:
+		self._ensure_running()
+		future = asyncio.get_event_loop().create_future()
+		self.queue.put_nowait((job, future))
+		return future
+
+	def _execute(self, batch: List[Tuple[Callable, asyncio.Future]]) -> List[Any]:
+		try:
+			results = [job(self.session) for job, _ in batch]
+			self.session.commit()
+		except Exception:
+			self.session.rollback()
+			raise
+		return results
+
+	async def _run(self):
+		loop = asyncio.get_event_loop()
+		while True:
+			batch = [await self.queue.get()]
+			while not self.queue.empty() and len(batch) < self.batch_size:
+				batch.append(self.queue.get_nowait())
+			try:
+				results = await loop.run_in_executor(self.executor, self._execute, batch)
+			except Exception as e:
+				log('DATABASE WRITE FAILED::', e)
+				self.failures += 1
+				for _, future in batch:
+					if not future.done():
+						future.set_exception(e)
+				continue
+			self.jobs += len(batch)
+			self.commits += 1
+			for (_, future), result in zip(batch, results):
+				if not future.done():
+					future.set_result(result)
+
+	async def close(self):
+		if self.task is None:
+			return
+		self.task.cancel()
+		try:
+			await self.task
+		except asyncio.CancelledError:
+			pass
+		self.task = None
+		# Lets a batch that was already running finish its commit.
+		self.executor.shutdown(wait=True)
+		self.executor = None
+
+	def stats(self) -> dict:
+		return {
+			'jobs': self.jobs,
+			'commits': self.commits,
+			'failures': self.failures,
+			'queued': self.queue.qsize() if self.queue else 0,
+		}
+
+
+writer = DatabaseWriter(SessionLocal())
@@ -0,0 +1,19 @@
+import pytest
+
+
+@pytest.fixture
+def db():
+	"""A session on an in-memory database with every table created."""
+	pytest.importorskip('sqlalchemy')
+	from sqlalchemy import create_engine
+	from sqlalchemy.orm import sessionmaker
+	from sqlalchemy.pool import StaticPool
+
+	from app.models import Base
+
+	engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+	Base.metadata.create_all(bind=engine)
+	session = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)()
+	yield session
+	session.close()
+	engine.dispose()
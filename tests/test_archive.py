@@ -0,0 +1,80 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('fastapi')
+
+from app import helpers
+from app.archive import ArchiveStore, day_range
+from app.models import Sensor, Temperature
+
+DAY = date(2020, 1, 1)
+SENSORS = [1, 2]
+
+
+def stamp(day: date, hour: int) -> datetime:
+	return datetime.combine(day, datetime.min.time()) + timedelta(hours=hour)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+	store = ArchiveStore(str(tmp_path))
+	monkeypatch.setattr(helpers, 'archive', store)
+	return store
+
+
+@pytest.fixture
+def readings(db):
+	"""Two days of hourly readings of two sensors in the table."""
+	db.add_all([Sensor(id=pk, pin=pk, sensor_type=1000) for pk in SENSORS])
+	for day in (DAY, DAY + timedelta(days=1)):
+		for hour in range(0, 24, 6):
+			for pk in SENSORS:
+				db.add(Temperature(sensor_id=pk, recorded_at=stamp(day, hour), temperature=pk * 10 + hour))
+	db.commit()
+	return db
+
+
+def archive_day(db, store: ArchiveStore, day: date):
+	"""What `retain` does for one day, with the test session."""
+	start, end = day_range(day)
+	rows = db.query(Temperature.recorded_at, Temperature.sensor_id, Temperature.temperature) \
+		.filter(Temperature.recorded_at >= start, Temperature.recorded_at < end).all()
+	recorded_at, sensor_id, temperature = zip(*rows)
+	store.write(day, (np.array(recorded_at, dtype='datetime64[us]'), np.array(sensor_id, dtype=np.int64),
+					  np.array(temperature, dtype=np.float64)))
+	db.query(Temperature).filter(Temperature.recorded_at >= start, Temperature.recorded_at < end) \
+		.delete(synchronize_session=False)
+	db.commit()
+	store.mark(end)
+
+
+def test_archived_rows_are_merged_in_order(readings, store):
+	before = helpers.pivot_temps(readings, SENSORS)
+	archive_day(readings, store, DAY)
+	assert readings.query(Temperature).count() == 8
+	assert helpers.pivot_temps(readings, SENSORS) == before
+	assert helpers.pivot_temps(readings, SENSORS, ascending=True) == before[::-1]
+	assert [row['recorded_at'] for row in before] == sorted((row['recorded_at'] for row in before), reverse=True)
+
+
+def test_pages_span_the_table_and_the_archive(readings, store):
+	before = helpers.pivot_temps(readings, SENSORS)
+	archive_day(readings, store, DAY)
+	pages = [helpers.pivot_temps(readings, SENSORS, skip=skip, limit=3) for skip in range(0, 8, 3)]
+	assert [row for page in pages for row in page] == before
+
+
+def test_iter_pivot_reads_the_archive(readings, store):
+	before = list(helpers.iter_pivot(readings, SENSORS, (None, None)))
+	archive_day(readings, store, DAY)
+	assert list(helpers.iter_pivot(readings, SENSORS, (None, None))) == before
+
+
+def test_day_archived_by_another_process_is_seen(readings, store, tmp_path):
+	before = helpers.pivot_temps(readings, SENSORS)
+	assert store.through is None
+	archive_day(readings, ArchiveStore(str(tmp_path)), DAY)
+	assert store.through == stamp(DAY + timedelta(days=1), 0)
+	assert helpers.pivot_temps(readings, SENSORS) == before
@@ -0,0 +1,68 @@
+import json
+import zlib
+
+import pytest
+
+pytest.importorskip('fastapi')
+
+from app.broadcast import Subscriber, Subscription
+
+
+def frame(date: str, *items, err: str = '') -> dict:
+	return {'data': [dict(item, date=date) for item in items], 'err': err}
+
+
+def render(subscriber: Subscriber, value: dict) -> dict:
+	return json.loads(subscriber.render(value, json.dumps(value)))
+
+
+def test_plain_subscription_gets_the_shared_message():
+	subscriber = Subscriber(None)
+	value = frame('d1', {'sensor_id': 1, 'temperature': 20.0})
+	assert subscriber.render(value, 'shared') == 'shared'
+
+
+def test_filter_by_house_or_sensor():
+	subscriber = Subscriber(None, Subscription(house_ids={1}, sensor_ids={5}))
+	value = frame('d1', {'sensor_id': 1, 'house_id': 1}, {'sensor_id': 2, 'house_id': 2}, {'sensor_id': 5, 'house_id': 2})
+	assert [item['sensor_id'] for item in render(subscriber, value)['data']] == [1, 5]
+
+
+def test_delta_frames_carry_only_changes():
+	subscriber = Subscriber(None, Subscription(delta=True))
+	first = render(subscriber, frame('d1', {'sensor_id': 1, 'temperature': 20.0, 'label': 'a'},
+									 {'sensor_id': 2, 'temperature': 21.0, 'label': 'b'}))
+	assert first == {'data': [{'sensor_id': 1, 'temperature': 20.0, 'label': 'a'},
+							  {'sensor_id': 2, 'temperature': 21.0, 'label': 'b'}],
+					 'err': '', 'delta': False, 'date': 'd1'}
+	subscriber.sent += 1
+	second = render(subscriber, frame('d2', {'sensor_id': 1, 'temperature': 20.5, 'label': 'a'},
+									  {'sensor_id': 2, 'temperature': 21.0, 'label': 'b'}))
+	assert second == {'data': [{'temperature': 20.5, 'sensor_id': 1}], 'err': '', 'delta': True, 'date': 'd2'}
+
+
+def test_new_sensor_is_sent_whole_in_a_delta_frame():
+	subscriber = Subscriber(None, Subscription(delta=True))
+	render(subscriber, frame('d1', {'sensor_id': 1, 'temperature': 20.0}))
+	subscriber.sent += 1
+	data = render(subscriber, frame('d2', {'sensor_id': 1, 'temperature': 20.0}, {'sensor_id': 3, 'temperature': 19.0}))['data']
+	assert data == [{'sensor_id': 3, 'temperature': 19.0}]
+
+
+def test_zlib_encoding():
+	subscriber = Subscriber(None, Subscription(encoding='zlib'))
+	value = frame('d1', {'sensor_id': 1, 'temperature': 20.0})
+	assert json.loads(zlib.decompress(subscriber.render(value, ''))) == value
+
+
+def test_unknown_encoding_is_rejected():
+	with pytest.raises(ValueError):
+		Subscription(encoding='gzip')
+
+
+def test_full_queue_drops_the_oldest_frame():
+	subscriber = Subscriber(None, size=2)
+	for seq in range(1, 4):
+		subscriber.push(seq, {}, '')
+	assert subscriber.dropped == 1
+	assert subscriber.queue.get_nowait()[0] == 2
@@ -0,0 +1,86 @@
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('fastapi')
+
+from app import export_cache as cache_module
+from app.export_cache import ExportCache, closed_window
+from app.models import Sensor, Temperature
+
+NOW = datetime(2020, 1, 2, 12, 0)
+WINDOW = (datetime(2020, 1, 1), datetime(2020, 1, 2))
+
+
+@pytest.fixture
+def db(db):
+	db.add_all([Sensor(id=pk, pin=pk, sensor_type=1000, label=f'S{pk}') for pk in (1, 2)])
+	db.add(Temperature(sensor_id=1, recorded_at=datetime(2020, 1, 1, 6), temperature=20.0))
+	db.commit()
+	return db
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+	monkeypatch.setattr(cache_module, 'BASE_DIR', str(tmp_path))
+	os.mkdir(tmp_path / 'downloads')
+	return ExportCache('downloads', quota=100)
+
+
+def test_open_window_is_not_cached():
+	assert closed_window(WINDOW, None, NOW)
+	assert not closed_window((WINDOW[0], None), None, NOW)
+	assert not closed_window((WINDOW[0], NOW), None, NOW)
+	assert not closed_window(WINDOW, 'day', WINDOW[1])
+
+
+def test_key_covers_the_request(db, cache):
+	key = cache.key(db, [1, 2], WINDOW, None, '.xlsx', NOW)
+	assert key == cache.key(db, [2, 1], WINDOW, None, '.xlsx', NOW)
+	assert key != cache.key(db, [1], WINDOW, None, '.xlsx', NOW)
+	assert key != cache.key(db, [1, 2], WINDOW, 'hour', '.xlsx', NOW)
+	assert key != cache.key(db, [1, 2], WINDOW, None, '.csv.gz', NOW)
+	assert cache.key(db, [1, 2], (WINDOW[0], None), None, '.xlsx', NOW) is None
+
+
+def test_key_changes_with_metadata_and_data(db, cache):
+	key = cache.key(db, None, WINDOW, None, '.xlsx', NOW)
+	db.query(Sensor).filter(Sensor.id == 2).update({'label': 'renamed'})
+	db.commit()
+	renamed = cache.key(db, None, WINDOW, None, '.xlsx', NOW)
+	assert renamed != key
+	db.add(Temperature(sensor_id=2, recorded_at=datetime(2020, 1, 1, 7), temperature=21.0))
+	db.commit()
+	assert cache.key(db, None, WINDOW, None, '.xlsx', NOW) != renamed
+
+
+def write(cache: ExportCache, name: str, size: int, age: float) -> str:
+	filename = os.path.join(cache.directory, name)
+	path = os.path.join(cache_module.BASE_DIR, filename)
+	with open(path, 'wb') as file:
+		file.write(b'x' * size)
+	stamp = time.time() - age
+	os.utime(path, (stamp, stamp))
+	return filename
+
+
+def test_lookup_counts_and_touches(cache):
+	filename = write(cache, 'a.xlsx', 10, 60)
+	assert cache.lookup(filename)
+	assert not cache.lookup(os.path.join(cache.directory, 'b.xlsx'))
+	assert (cache.hits, cache.misses) == (1, 1)
+	assert time.time() - os.stat(os.path.join(cache_module.BASE_DIR, filename)).st_mtime < 5
+
+
+def test_evict_removes_least_recently_used_first(cache):
+	oldest = write(cache, 'old.xlsx', 50, 300)
+	kept = write(cache, 'kept.xlsx', 30, 200)
+	running = write(cache, 'run.abc.tmp.xlsx', 20, 100)
+	recent = write(cache, 'recent.xlsx', 30, 0)
+	assert cache.evict(keep=[kept]) == [oldest]
+	cache.quota = 60
+	assert cache.evict() == [kept]
+	assert {os.path.basename(path) for path, _ in cache.files()} == {os.path.basename(running), os.path.basename(recent)}
@@ -0,0 +1,48 @@
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('fastapi')
+
+from app import helpers
+from app.archive import ArchiveStore
+from app.helpers import export_label, get_temps
+from app.models import Sensor, Temperature
+
+DATE = datetime(2020, 1, 1, 6)
+
+
+@pytest.fixture
+def db(db, tmp_path, monkeypatch):
+	monkeypatch.setattr(helpers, 'archive', ArchiveStore(str(tmp_path)))
+	db.add_all([
+		Sensor(id=1, pin=1, sensor_type=1000, location='up', label='A', house_id=1),
+		Sensor(id=2, pin=2, sensor_type=1000, location='down', house_id=1),
+		Sensor(id=3, pin=3, sensor_type=1000, location=None, label='SIM0-3'),
+	])
+	db.add_all([Temperature(sensor_id=1, recorded_at=DATE, temperature=20.0),
+				Temperature(sensor_id=2, recorded_at=DATE, temperature=21.0)])
+	db.commit()
+	return db
+
+
+def test_export_label():
+	assert export_label(Sensor(pin=4, location='up', label='A')) == 'ТВ-4(A)'
+	assert export_label(Sensor(pin=4, location='down')) == 'ТН-4'
+	assert export_label(Sensor(pin=4, location='boiler', label='Котёл')) == 'Котёл'
+	assert export_label(Sensor(pin=4, location=None, label='SIM0-4')) == 'SIM0-4'
+	assert export_label(Sensor(pin=4, location='attic')) == ''
+
+
+def test_export_rows_hold_only_the_sensors_in_range(db):
+	rows = get_temps(db, sensor_ids=None, start_date=None, end_date=None, skip=None, limit=None, cursor=None,
+					 resolution=None, export=True)
+	assert [list(row) for row in rows] == [['ТВ-1(A)', 'ТН-2', 'recorded_at']]
+
+
+def test_sensor_without_location_is_exported(db):
+	db.add(Temperature(sensor_id=3, recorded_at=DATE, temperature=22.0))
+	db.commit()
+	meta, _ = helpers.export_readings(db, None, (None, None))
+	assert sorted(sensor.label for sensor in meta.values()) == ['SIM0-3', 'ТВ-1(A)', 'ТН-2']
@@ -0,0 +1,66 @@
+import pytest
+
+from app import gpio
+from app.gpio import GPIO, Relay
+
+PIN = 8
+
+
+@pytest.fixture
+def clock(monkeypatch):
+	if not hasattr(GPIO, 'writes'):
+		pytest.skip('needs the GPIO stand-in, RPi.GPIO is installed')
+	now = [1000.0]
+	monkeypatch.setattr(gpio.time, 'monotonic', lambda: now[0])
+	monkeypatch.setattr(Relay, 'states', {})
+	monkeypatch.setattr(Relay, 'changed_at', {})
+	monkeypatch.setattr(Relay, 'writes', {})
+	monkeypatch.setattr(GPIO, 'writes', 0)
+	Relay.setup(PIN)
+	return now
+
+
+def test_setup_switches_off(clock):
+	assert GPIO.writes == 1
+	assert Relay.states[PIN] is False
+
+
+def test_unchanged_state_is_not_written(clock):
+	assert not Relay.turn_off(PIN)
+	assert Relay.turn_on(PIN)
+	for _ in range(10):
+		assert not Relay.turn_on(PIN)
+	assert GPIO.writes == 2
+	assert Relay.writes[PIN] == 2
+
+
+def test_first_change_after_setup_ignores_dwell(clock):
+	assert Relay.turn_on(PIN, min_on=60, min_off=60)
+	assert GPIO.writes == 2
+
+
+def test_min_on_postpones_switching_off(clock):
+	Relay.turn_on(PIN)
+	clock[0] += 30
+	assert not Relay.turn_off(PIN, min_on=60)
+	assert Relay.states[PIN] is True
+	clock[0] += 30
+	assert Relay.turn_off(PIN, min_on=60)
+	assert Relay.states[PIN] is False
+	assert GPIO.writes == 3
+
+
+def test_min_off_postpones_switching_on(clock):
+	Relay.turn_on(PIN)
+	Relay.turn_off(PIN)
+	clock[0] += 5
+	assert not Relay.turn_on(PIN, min_off=10)
+	clock[0] += 5
+	assert Relay.turn_on(PIN, min_off=10)
+	assert GPIO.writes == 4
+
+
+def test_snapshot_reports_writes(clock):
+	Relay.turn_on(PIN)
+	clock[0] += 2
+	assert Relay.snapshot() == [{'pin': PIN, 'on': True, 'seconds_in_state': 2.0, 'writes': 2}]
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from app.jobs import JobRunner
+
+
+def test_reserve_stops_at_max_pending():
+	jobs = JobRunner(workers=1, max_pending=2)
+	assert jobs.reserve()
+	assert jobs.reserve()
+	assert not jobs.reserve()
+	jobs.release()
+	assert jobs.reserve()
+	assert jobs.stats()['pending'] == 2
+
+
+def test_submitted_job_frees_its_slot():
+	jobs = JobRunner(workers=1, max_pending=1)
+
+	async def run():
+		assert jobs.reserve()
+		assert await jobs.submit(abs, -3) == 3
+		await asyncio.sleep(0)
+
+	try:
+		asyncio.run(run())
+	finally:
+		jobs.shutdown()
+	assert jobs.stats()['pending'] == 0
+	assert jobs.stats()['completed'] == 1
+
+
+def test_job_that_cannot_start_is_failed(db, tmp_path, monkeypatch):
+	pytest.importorskip('fastapi')
+	import importlib
+	from concurrent.futures.process import BrokenProcessPool
+	from sqlalchemy.orm import sessionmaker
+
+	from app.models import Download
+	from app.validators.Download import InputValidator
+
+	# app.routes re-exports the router under the module's name.
+	exports = importlib.import_module('app.routes.exports')
+
+	def submit(*args):
+		raise BrokenProcessPool('A child process terminated abruptly')
+
+	jobs = JobRunner(workers=1, max_pending=1)
+	monkeypatch.setattr(jobs, 'submit', submit)
+	monkeypatch.setattr(exports, 'export_jobs', jobs)
+	monkeypatch.setattr(exports, 'BASE_DIR', str(tmp_path))
+	monkeypatch.setattr(exports, 'SessionLocal', sessionmaker(bind=db.get_bind()))
+	with pytest.raises(BrokenProcessPool):
+		asyncio.run(exports.create_export(InputValidator(label='export'), db))
+	assert jobs.stats()['pending'] == 0
+	download = db.query(Download).populate_existing().one()
+	assert (download.status, download.error) == ('failed', 'A child process terminated abruptly')
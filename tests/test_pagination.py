@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip('numpy')
+fastapi = pytest.importorskip('fastapi')
+
+from app import helpers
+from app.archive import ArchiveStore
+from app.helpers import decode_cursor, encode_cursor, paginate_temps
+from app.models import Sensor, Temperature
+
+START = datetime(2020, 1, 1)
+SENSORS = [1, 2]
+STAMPS = [START + timedelta(minutes=15 * idx) for idx in range(10)]
+
+
+@pytest.fixture
+def db(db, tmp_path, monkeypatch):
+	monkeypatch.setattr(helpers, 'archive', ArchiveStore(str(tmp_path)))
+	db.add_all([Sensor(id=pk, pin=pk, sensor_type=1000) for pk in SENSORS])
+	db.add_all([Temperature(sensor_id=pk, recorded_at=date, temperature=idx + pk / 10)
+				for idx, date in enumerate(STAMPS) for pk in SENSORS])
+	db.commit()
+	return db
+
+
+def dates(page: dict) -> list:
+	return [row['recorded_at'] for row in page['data']]
+
+
+def test_cursor_round_trip():
+	date = datetime(2020, 1, 1, 12, 30, 15, 250)
+	assert decode_cursor(encode_cursor('before', date)) == ('before', date)
+	assert decode_cursor(encode_cursor('after', date)) == ('after', date)
+
+
+@pytest.mark.parametrize('cursor', ['not base64!', encode_cursor('before', START).rstrip('=') + 'x',
+									helpers.base64.urlsafe_b64encode(b'sideways:2020-01-01').decode()])
+def test_invalid_cursor_is_rejected(cursor):
+	with pytest.raises(fastapi.HTTPException) as error:
+		decode_cursor(cursor)
+	assert error.value.status_code == 400
+
+
+def test_next_pages_walk_back_without_gaps(db):
+	page = paginate_temps(db, SENSORS, (None, None), None, 4, None)
+	assert page['total'] == 10
+	assert page['prev'] is None
+	seen = dates(page)
+	while page['next']:
+		page = paginate_temps(db, SENSORS, (None, None), None, 4, page['next'])
+		assert page['prev'] is not None
+		seen += dates(page)
+	assert seen == STAMPS[::-1]
+	assert page['data'][-1] == {1: 0.1, 2: 0.2, 'recorded_at': STAMPS[0]}
+
+
+def test_prev_page_returns_the_page_before(db):
+	first = paginate_temps(db, SENSORS, (None, None), None, 4, None)
+	second = paginate_temps(db, SENSORS, (None, None), None, 4, first['next'])
+	back = paginate_temps(db, SENSORS, (None, None), None, 4, second['prev'])
+	assert dates(back) == dates(first)
+	assert back['prev'] is None
+	assert back['next'] is not None
+
+
+def test_cursor_stays_inside_the_window(db):
+	window = (STAMPS[2], STAMPS[7])
+	page = paginate_temps(db, SENSORS, window, None, 2, None)
+	seen = dates(page)
+	while page['next']:
+		page = paginate_temps(db, SENSORS, window, None, 2, page['next'])
+		seen += dates(page)
+	assert seen == STAMPS[6:2:-1]
+
+
+def test_skip_still_pages_with_offset(db):
+	page = paginate_temps(db, SENSORS, (None, None), 4, 4, None)
+	assert dates(page) == STAMPS[5:1:-1]
+	assert page['prev'] is not None
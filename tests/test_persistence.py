@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from app.models import Sensor, Temperature, TemperatureHourly
+from app.persistence import BucketWriter
+from app.settings import BUCKET_MINUTES
+
+START = datetime(2020, 1, 1, 10, 0)
+
+
+@pytest.fixture
+def db(db):
+	db.add_all([Sensor(id=pk, pin=pk, sensor_type=1000) for pk in (1, 2)])
+	db.commit()
+	return db
+
+
+def readings(*values) -> list:
+	return [{'sensor_id': pk, 'temperature': value} for pk, value in enumerate(values, 1)]
+
+
+def rows(db) -> list:
+	return db.query(Temperature.sensor_id, Temperature.recorded_at, Temperature.temperature) \
+		.order_by(Temperature.recorded_at, Temperature.sensor_id).all()
+
+
+def test_first_reading_per_bucket_is_kept(db):
+	buckets = BucketWriter()
+	assert buckets.write(db, readings(20.0, 0.0), START) == 2
+	assert buckets.write(db, readings(21.0, 1.0), START + timedelta(minutes=1)) == 0
+	assert rows(db) == [(1, START, 20.0), (2, START, 0.0)]
+
+
+def test_missing_values_are_skipped(db):
+	buckets = BucketWriter()
+	assert buckets.write(db, readings(None, float('nan')), START) == 0
+	assert buckets.write(db, readings(20.0), START) == 1
+
+
+def test_new_bucket_rolls_up_the_closed_one(db):
+	buckets = BucketWriter()
+	buckets.write(db, readings(20.0, 22.0), START)
+	later = START + timedelta(minutes=BUCKET_MINUTES)
+	assert buckets.write(db, readings(24.0, 26.0), later) == 2
+	hourly = db.query(TemperatureHourly.sensor_id, TemperatureHourly.temperature, TemperatureHourly.count) \
+		.order_by(TemperatureHourly.sensor_id).all()
+	assert hourly == [(1, 20.0, 1), (2, 22.0, 1)]
+
+
+def test_reopened_bucket_knows_its_rows(db):
+	BucketWriter().write(db, readings(20.0), START)
+	assert BucketWriter().write(db, readings(21.0, 22.0), START) == 1
+
+
+def test_forgotten_rows_are_written_again(db):
+	buckets = BucketWriter()
+	data = readings(20.0, 22.0)
+	buckets.write(db, data, START)
+	db.rollback()
+	buckets.forget(data)
+	assert buckets.write(db, data, START) == 2
+	assert len(rows(db)) == 2
+
+
+def test_rolled_back_open_rolls_up_the_closed_bucket_again(db):
+	buckets = BucketWriter()
+	buckets.write(db, readings(20.0, 22.0), START)
+	db.commit()
+	later = START + timedelta(minutes=BUCKET_MINUTES)
+	data = readings(24.0, 26.0)
+	buckets.write(db, data, later)
+	db.rollback()
+	buckets.forget(data)
+	assert db.query(TemperatureHourly).count() == 0
+	assert buckets.write(db, data, later) == 2
+	assert db.query(TemperatureHourly).count() == 2
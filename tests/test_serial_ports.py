@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('serial')
+pytest.importorskip('sqlalchemy')
+
+from app.conversion import RtdConverter
+from app.models import Sensor
+from app.registry import Registry
+from app.serial_ports import SerialPorts
+
+
+class Controller:
+	def __init__(self, port: str):
+		self.port = port
+		self.connected = False
+		self.closed = False
+
+	async def connect_to_serial(self):
+		self.connected = True
+
+	async def read(self):
+		await asyncio.sleep(0.01)
+		return [{'pin': 1, 'rtd': 8000}], ''
+
+	def close(self):
+		self.closed = True
+		self.connected = False
+
+	def stats(self):
+		return []
+
+
+@pytest.fixture
+def converter():
+	registry = Registry()
+	registry.load([Sensor(id=1, pin=1, port=None, sensor_type=1000, disabled=False)], [])
+	return RtdConverter(registry)
+
+
+def test_portless_sensor_is_read_on_one_port(converter):
+	positions, rows, _, _ = converter.convert([1, 1], [8000, 8000], ['ttyACM0', 'ttyACM1'])
+	assert positions == [0]
+	assert converter.convert([1], [8000], ['ttyACM1'])[0] == []
+
+
+def test_released_port_frees_its_sensors(converter):
+	converter.convert([1], [8000], ['ttyACM0'])
+	converter.release('ttyACM0')
+	assert converter.convert([1], [8000], ['ttyACM1'])[0] == [0]
+
+
+def test_registry_change_frees_bound_sensors(converter):
+	converter.convert([1], [8000], ['ttyACM0'])
+	converter.registry.update_sensor(converter.registry.sensors[1])
+	assert converter.convert([1], [8000], ['ttyACM1'])[0] == [0]
+
+
+def test_vanished_controller_is_dropped_and_released():
+	ports = ['ttyACM0']
+	released = []
+
+	async def run():
+		serial_ports = SerialPorts(Controller, lambda: list(ports), merge_window=0, on_release=released.append)
+		serial_ports.queue = asyncio.Queue()
+		await serial_ports._discover()
+		old = serial_ports.controllers['ttyACM0']
+		assert (await serial_ports.read())[0][0]['port'] == 'ttyACM0'
+		serial_ports.errors['ttyACM0'] = 'Не удалось считать данные с сенсора'
+		ports[:] = ['ttyACM1']
+		await serial_ports._discover()
+		assert old.closed
+		assert list(serial_ports.controllers) == ['ttyACM1']
+		assert 'ttyACM0' not in serial_ports.errors
+		data, error = await serial_ports.read()
+		assert {item['port'] for item in data} == {'ttyACM1'}
+		assert error == ''
+		for task in serial_ports.pumps.values():
+			task.cancel()
+
+	asyncio.run(run())
+	assert released == ['ttyACM0']
+
+
+def test_seeded_sensors_validate_and_export(db):
+	from app.helpers import export_label
+	from app.serial_port_simulator import SerialPortWrapper
+	from app.validators.Sensor import ResponseValidator
+
+	assert SerialPortWrapper('SIM0', sensors=2)._seed(db) == 2
+	db.commit()
+	sensors = db.query(Sensor).order_by(Sensor.pin).all()
+	assert [export_label(sensor) for sensor in sensors] == ['SIM0-1', 'SIM0-2']
+	assert ResponseValidator.from_orm(sensors[0]).location == 'street'
+	assert SerialPortWrapper('SIM0', sensors=3)._seed(db) == 1
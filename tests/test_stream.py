@@ -0,0 +1,23 @@
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('fastapi')
+
+from app.helpers import csv_lines, ndjson_lines
+
+DATE = datetime(2020, 1, 1)
+
+
+def test_csv_of_an_empty_range_has_the_header():
+	assert list(csv_lines([], [1, 2])) == ['recorded_at,1,2\r\n']
+
+
+def test_csv_rows_follow_the_header():
+	rows = [{1: 20.5, 'recorded_at': DATE}]
+	assert ''.join(csv_lines(rows, [1, 2])) == 'recorded_at,1,2\r\n2020-01-01T00:00:00,20.5,\r\n'
+
+
+def test_ndjson_line_per_row():
+	assert list(ndjson_lines([{'1': 20.5, 'recorded_at': DATE}])) == ['{"1": 20.5, "recorded_at": "2020-01-01T00:00:00"}\n']